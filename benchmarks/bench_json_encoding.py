@@ -0,0 +1,99 @@
+"""Compares JSON encoders for 1,000-book feed pages.
+
+Run from the project directory, with a local_settings.cfg in place:
+
+    python -m benchmarks.bench_json_encoding
+"""
+
+import argparse
+import json
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from opds_springer import feed_generator
+from opds_springer.feed_generator import BookOPDS, encode_json
+
+
+def synthetic_page(page_size):
+    """Creates an OPDS page with page_size synthetic books."""
+    publications = []
+    for i in range(page_size):
+        book = SimpleNamespace(
+            book_id=f"10.1007/978-3-031-{i:05}-3",
+            modified=datetime(2023, 8, 11, 12, 0, i % 60),
+            title=f"Pseudo-Monotone Operator Theory for Unsteady Problems {i}",
+            language="en",
+            publisher="Springer International Publishing",
+            published="2023-08-11",
+            authors="Kaltenbach, Alex|Müller, Jürgen",
+            editors=None,
+            ebook_isbn=f"978-3-031-{i:05}-3",
+            subjects=[
+                SimpleNamespace(subject=s)
+                for s in ("Mathematics", "Analysis", "Functional Analysis")
+            ],
+            links=[
+                SimpleNamespace(
+                    pub_type=pub_type,
+                    href=f"http://link.springer.com/openurl/{pub_type}?id=doi:{i}",
+                )
+                for pub_type in ("pdf", "epub")
+            ],
+        )
+        publications.append(BookOPDS().create_json(book))
+    return {
+        "metadata": {"title": "Springer Feed", "itemsPerPage": page_size},
+        "links": [],
+        "publications": publications,
+    }
+
+
+def write_current(opds_page, output_file):
+    """Writes a page the way write_json did before encode_json."""
+    with open(output_file, "w") as json_file:
+        json.dump(opds_page, json_file, indent=4)
+
+
+def write_encoded(opds_page, output_file, orjson, indent):
+    """Writes a page from a single pre-encoded buffer with the given backend."""
+    with patch.object(feed_generator, "orjson", orjson):
+        output_file.write_bytes(encode_json(opds_page, indent))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    opds_page = synthetic_page(args.page_size)
+    variants = [("json.dump, indent=4 (before)", write_current)]
+    backends = [("stdlib", None)]
+    if feed_generator.orjson:
+        backends.append(("orjson", feed_generator.orjson))
+    for backend, orjson in backends:
+        for indent in (True, False):
+            variants.append(
+                (
+                    f"encode_json {backend}, indent={indent}",
+                    partial(write_encoded, orjson=orjson, indent=indent),
+                )
+            )
+    print(f"{'variant':<40}{'pages/sec':>12}{'size (KB)':>12}")
+    with TemporaryDirectory() as temp_dir:
+        for name, write in variants:
+            output_file = Path(temp_dir, "page.json")
+            start = perf_counter()
+            for _ in range(args.repeat):
+                write(opds_page, output_file)
+            elapsed = perf_counter() - start
+            size = output_file.stat().st_size / 1024
+            print(f"{name:<40}{args.repeat / elapsed:>12.1f}{size:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Times subject, link and association lookups before and after upgrade_schema.
+
+Run from the project directory, with a local_settings.cfg in place:
+
+    python -m benchmarks.bench_schema_indexes --books 100000
+"""
+
+import argparse
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from sqlalchemy import create_engine, select
+
+from opds_springer.books_db import Link, Subject, association_table, upgrade_schema
+
+# the schema before subject, association_table and link were indexed
+OLD_SCHEMA = [
+    """CREATE TABLE book (
+        book_id VARCHAR(50) NOT NULL,
+        title VARCHAR(256),
+        print_isbn VARCHAR(50),
+        ebook_isbn VARCHAR(50),
+        publisher VARCHAR(256),
+        published VARCHAR(256),
+        series_id INTEGER,
+        language VARCHAR(50),
+        description VARCHAR(50),
+        authors VARCHAR(256),
+        editors VARCHAR(256),
+        modified DATETIME DEFAULT (CURRENT_TIMESTAMP),
+        PRIMARY KEY (book_id)
+    )""",
+    """CREATE TABLE subject (
+        subject_id INTEGER NOT NULL,
+        subject VARCHAR(256),
+        source VARCHAR(50),
+        PRIMARY KEY (subject_id)
+    )""",
+    """CREATE TABLE link (
+        id INTEGER NOT NULL,
+        rel VARCHAR(256),
+        pub_type VARCHAR(50),
+        href VARCHAR(256),
+        book_id VARCHAR(50),
+        PRIMARY KEY (id),
+        FOREIGN KEY(book_id) REFERENCES book (book_id)
+    )""",
+    """CREATE TABLE association_table (
+        book_id VARCHAR(50),
+        subject_id INTEGER,
+        FOREIGN KEY(book_id) REFERENCES book (book_id),
+        FOREIGN KEY(subject_id) REFERENCES subject (subject_id)
+    )""",
+]
+
+
+def create_catalog(engine, book_count, subject_count):
+    """Creates a catalog with the old schema, 2 links and 3 subjects per book."""
+    random = Random(0)
+    book_ids = [f"10.1007/978-3-{i:09}-0" for i in range(book_count)]
+    with engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql(
+            "INSERT INTO book (book_id, title) VALUES (?, ?)",
+            [(book_id, f"Book {book_id}") for book_id in book_ids],
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO subject (subject, source) VALUES (?, ?)",
+            [(f"Subject {i}", "springer") for i in range(subject_count)],
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO link (pub_type, href, book_id) VALUES (?, ?, ?)",
+            [
+                (pub_type, f"https://link.springer.com/{pub_type}/{book_id}", book_id)
+                for book_id in book_ids
+                for pub_type in ("pdf", "epub")
+            ],
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO association_table VALUES (?, ?)",
+            [
+                (book_id, subject_id)
+                for book_id in book_ids
+                for subject_id in random.sample(range(1, subject_count + 1), 3)
+            ],
+        )
+    return book_ids
+
+
+def time_lookups(engine, book_ids, subject_count, page_size, repeat):
+    """Times each kind of lookup.
+
+    Returns:
+        dict: average milliseconds per lookup
+    """
+    random = Random(1)
+    pages = [random.sample(book_ids, page_size) for _ in range(repeat)]
+    subjects = [f"Subject {random.randrange(subject_count)}" for _ in range(repeat)]
+    lookups = {
+        "subject by name": [
+            select(Subject.subject_id).where(
+                Subject.subject == subject, Subject.source == "springer"
+            )
+            for subject in subjects
+        ],
+        f"links of {page_size} books": [
+            select(Link).where(Link.book_id.in_(page)) for page in pages
+        ],
+        f"subjects of {page_size} books": [
+            select(association_table.c.book_id, Subject)
+            .join(Subject)
+            .where(association_table.c.book_id.in_(page))
+            for page in pages
+        ],
+    }
+    timings = {}
+    with engine.connect() as connection:
+        for name, queries in lookups.items():
+            start = perf_counter()
+            for query in queries:
+                connection.execute(query).all()
+            timings[name] = (perf_counter() - start) / len(queries) * 1000
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=100000)
+    parser.add_argument("--subjects", type=int, default=2000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    with TemporaryDirectory() as temp_dir:
+        engine = create_engine(f"sqlite:///{Path(temp_dir, 'bench.db')}")
+        book_ids = create_catalog(engine, args.books, args.subjects)
+        lookup_args = (book_ids, args.subjects, args.page_size, args.repeat)
+        before = time_lookups(engine, *lookup_args)
+        start = perf_counter()
+        upgrade_schema(engine)
+        print(f"upgrade_schema took {perf_counter() - start:.2f}s")
+        after = time_lookups(engine, *lookup_args)
+    print(f"{'lookup (ms)':<30}{'before':>12}{'after':>12}")
+    for name in before:
+        print(f"{name:<30}{before[name]:>12.2f}{after[name]:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Generates synthetic Springer records and catalogs of any size.
+
+Records are variations on the 100 records in fixtures/springer_crawl_example.json,
+with their subjects, contributors and links, and a DOI made from their index,
+so the mock API and the catalog agree on every book.
+
+    python -m benchmarks.catalog --books 100000 --db-url sqlite:///catalog.db
+"""
+
+import argparse
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import select
+
+from opds_springer.book_saver import api_book_data, book_fingerprint, chunks
+from opds_springer.books_db import (
+    Book,
+    Link,
+    Subject,
+    association_table,
+    create_db_engine,
+    upgrade_schema,
+)
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / "fixtures"
+DOI_PREFIX = "10.1007/978-9-"
+
+with open(FIXTURES_DIR / "springer_crawl_example.json") as f:
+    BASE_RECORDS = json.load(f)["records"]
+
+SUBJECTS = sorted({s for record in BASE_RECORDS for s in record["subjects"]})
+
+KBART_COLUMNS = [
+    "publication_title",
+    "print_identifier",
+    "online_identifier",
+    "title_url",
+    "first_author",
+    "title_id",
+    "publisher_name",
+    "publication_type",
+    "parent_publication_title_id",
+]
+
+
+def book_doi(index):
+    """Gets the DOI of the synthetic book with an index."""
+    return f"{DOI_PREFIX}{index // 100000:04}-{index % 100000:05}-0"
+
+
+def doi_index(doi):
+    """Gets the index of a synthetic book from its DOI, or None."""
+    if not doi.startswith(DOI_PREFIX):
+        return None
+    try:
+        high, low, _ = doi[len(DOI_PREFIX) :].split("-")
+        return int(high) * 100000 + int(low)
+    except ValueError:
+        return None
+
+
+def synthetic_record(index):
+    """Creates the Springer API record of a synthetic book.
+
+    Args:
+        index (int): index of the book
+
+    Returns:
+        dict: record in the form of the bookmeta API
+    """
+    base = BASE_RECORDS[index % len(BASE_RECORDS)]
+    doi = book_doi(index)
+    return dict(
+        base,
+        identifier=f"doi:{doi}",
+        doi=doi,
+        publicationName=f"{base['publicationName']} {index}",
+        electronicIsbn=doi.split("/")[1],
+        url=[
+            {
+                "format": "pdf",
+                "platform": "web",
+                "value": f"http://link.springer.com/openurl/pdf?id=doi:{doi}",
+            },
+            {
+                "format": "epub",
+                "platform": "web",
+                "value": f"https://link.springer.com/download/epub/{doi}.epub",
+            },
+            {"format": "", "platform": "", "value": f"http://dx.doi.org/{doi}"},
+        ],
+    )
+
+
+def catalog_books(indexes):
+    """Formats synthetic records with api_book_data, as the API path does.
+
+    Args:
+        indexes (iterable): indexes of the books
+
+    Yields:
+        tuple: index of the book, and its book, link and subject data with a
+    fingerprint
+    """
+    for index in indexes:
+        book_data = api_book_data(synthetic_record(index))
+        book_data["book"]["fingerprint"] = book_fingerprint(book_data)
+        yield index, book_data
+
+
+def kbart_row(index):
+    """Creates the kbart row of a synthetic book.
+
+    Args:
+        index (int): index of the book
+
+    Returns:
+        dict: kbart values by column
+    """
+    record = synthetic_record(index)
+    creators = record.get("creators") or [{"creator": ""}]
+    return {
+        "publication_title": record["publicationName"],
+        "print_identifier": record["printIsbn"],
+        "online_identifier": record["electronicIsbn"],
+        "title_url": f"https://link.springer.com/{record['doi']}",
+        "first_author": creators[0]["creator"],
+        "title_id": record["doi"],
+        "publisher_name": record["publisherName"],
+        "publication_type": "monograph",
+        "parent_publication_title_id": record.get("seriesId") or "",
+    }
+
+
+def write_kbart(path, indexes):
+    """Writes a kbart file with a row for each index.
+
+    Args:
+        path (str): path of the kbart file
+        indexes (iterable): indexes of the books
+    """
+    with open(path, "w") as kbart_file:
+        kbart_file.write("\t".join(KBART_COLUMNS) + "\n")
+        for index in indexes:
+            row = kbart_row(index)
+            kbart_file.write("\t".join(row[c] for c in KBART_COLUMNS) + "\n")
+
+
+def generate_catalog(db_url, count, batch_size=10000):
+    """Fills a database with synthetic books, links and subjects.
+
+    Books are added with created and modified times one second apart, oldest
+    first.
+
+    Args:
+        db_url (str): SQLAlchemy URL of the database
+        count (int): number of books
+        batch_size (int): number of books inserted per transaction
+
+    Returns:
+        float: seconds taken
+    """
+    start_time = perf_counter()
+    engine = create_db_engine(db_url)
+    upgrade_schema(engine)
+    first_saved = datetime(2020, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(
+            Subject.__table__.insert(),
+            [{"subject": s, "source": "springer"} for s in SUBJECTS],
+        )
+        subject_ids = dict(
+            connection.execute(select(Subject.subject, Subject.subject_id)).all()
+        )
+    for indexes in chunks(range(count), batch_size):
+        books = []
+        links = []
+        subjects = []
+        for index, data in catalog_books(indexes):
+            book_id = data["book"]["book_id"]
+            saved = first_saved + timedelta(seconds=index)
+            books.append(dict(data["book"], created=saved, modified=saved))
+            for pub_type, href in data["links"]:
+                links.append({"book_id": book_id, "pub_type": pub_type, "href": href})
+            for subject in dict.fromkeys(data["subjects"]):
+                subjects.append(
+                    {"book_id": book_id, "subject_id": subject_ids[subject]}
+                )
+        with engine.begin() as connection:
+            connection.execute(Book.__table__.insert(), books)
+            connection.execute(Link.__table__.insert(), links)
+            connection.execute(association_table.insert(), subjects)
+    engine.dispose()
+    return perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--db-url", required=True)
+    parser.add_argument("--kbart", help="Also write a kbart file of the books.")
+    args = parser.parse_args()
+    elapsed = generate_catalog(args.db_url, args.books)
+    print(f"Generated {args.books} books in {elapsed:.1f}s")
+    if args.kbart:
+        write_kbart(args.kbart, range(args.books))
+
+
+if __name__ == "__main__":
+    main()
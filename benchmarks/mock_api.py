@@ -0,0 +1,95 @@
+"""Serves synthetic records in the form of the Springer bookmeta API.
+
+Answers dateloadedfrom: queries with a range of synthetic books, and OR'd doi:
+queries with the synthetic book for each DOI, after a fixed latency.
+
+    python -m benchmarks.mock_api --records 10000 --latency 0.1 --port 8080
+"""
+
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.catalog import doi_index, synthetic_record
+
+
+class BookmetaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        sleep(self.server.latency)
+        query = params.get("q", "")
+        start = int(params.get("s", 1))
+        page_length = int(params.get("p", 10))
+        if query.startswith("dateloadedfrom:"):
+            first, last = self.server.first_record, self.server.last_record
+            indexes = range(
+                first + start - 1, min(first + start - 1 + page_length, last)
+            )
+            total = last - first
+        else:
+            dois = [term.strip("() ")[len("doi:") :] for term in query.split(" OR ")]
+            matched = [doi_index(doi) for doi in dois]
+            matched = [index for index in matched if index is not None]
+            indexes = matched[start - 1 : start - 1 + page_length]
+            total = len(matched)
+        body = json.dumps(
+            {
+                "result": [{"total": str(total), "start": str(start)}],
+                "records": [synthetic_record(index) for index in indexes],
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockBookmetaServer(object):
+    def __init__(self, first_record=0, records=1000, latency=0.0, port=0):
+        """Mock bookmeta API running in a background thread.
+
+        Args:
+            first_record (int): index of the first book loaded since any date
+            records (int): number of books loaded since any date
+            latency (float): seconds to wait before each response
+            port (int): port to listen on, or 0 for any free port
+        """
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), BookmetaHandler)
+        self.server.daemon_threads = True
+        self.server.first_record = first_record
+        self.server.last_record = first_record + records
+        self.server.latency = latency
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/bookmeta/v1/json"
+
+    def __enter__(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--first-record", type=int, default=0)
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    server = MockBookmetaServer(
+        args.first_record, args.records, args.latency, args.port
+    )
+    print(f"Serving {args.records} records at {server.url}")
+    server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Runs ingest and feed generation against synthetic catalogs and a mock API.
+
+For each catalog size, a catalog is generated and these scenarios are run, each
+in a new process:
+
+    feed    GenerateFeed.opds_feed over the whole catalog
+    api     save_books_from_api, with --api-records new books from the mock API
+    kbart   save_books_from_kbart, with --kbart-rows rows, half of them books
+            already in the catalog
+
+Wall time, peak RSS and database query counts are written to a JSON results
+file, which can be compared with the results of another commit:
+
+    python -m benchmarks.run --sizes 10000 100000 --output after.json
+    python -m benchmarks.run --sizes 10000 100000 --compare before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+from configparser import ConfigParser
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.catalog import generate_catalog, write_kbart
+from benchmarks.mock_api import MockBookmetaServer
+
+SCENARIOS = ("feed", "api", "kbart")
+
+
+def write_settings(settings_dir, db_url, workers):
+    """Writes the local_settings.cfg used by a benchmark run.
+
+    Args:
+        settings_dir (str): directory of the run
+        db_url (str): SQLAlchemy URL of the catalog
+        workers (int): number of processes writing feed pages
+    """
+    config = ConfigParser()
+    config["Springer"] = {
+        "api_key": "benchmark",
+        "entitlement": "benchmark",
+        "kbart_path": str(Path(settings_dir, "kbart.txt")),
+        "fetch_workers": "4",
+        "page_workers": "4",
+        "cache_path": "",
+    }
+    config["Database"] = {"db": db_url, "batch_size": "500"}
+    config["Feed"] = {
+        "json_dir": str(Path(settings_dir, "feed")),
+        "title": "Benchmark Feed",
+        "base_url": "https://example.org/feed",
+        "precompress": "",
+        "workers": str(workers),
+    }
+    with open(Path(settings_dir, "local_settings.cfg"), "w") as settings_file:
+        config.write(settings_file)
+
+
+def peak_rss_mb():
+    """Gets the peak resident memory of this process and its children in MB."""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(scenario, api_url, results):
+    """Runs one scenario in the current directory and reports its measurements.
+
+    Meant to be the target of a new process started in the run's directory, so
+    that the package reads the run's local_settings.cfg and the peak memory is
+    the scenario's own.
+
+    Args:
+        scenario (str): feed, api or kbart
+        api_url (str): URL of the mock bookmeta API
+        results (Queue): queue the measurements are put on
+    """
+    from opds_springer.book_saver import BookData, SpringerClient
+    from opds_springer.feed_generator import GenerateFeed
+    from opds_springer.metrics import metrics
+
+    SpringerClient.BASE_URL = api_url
+    metrics.reset()
+    start_time = perf_counter()
+    if scenario == "feed":
+        GenerateFeed().opds_feed()
+    elif scenario == "api":
+        BookData().save_books_from_api(1)
+    else:
+        BookData().save_books_from_kbart()
+    wall_time = perf_counter() - start_time
+    summary = metrics.summary()
+    queries = summary["timers"].get("db.query", {"count": 0, "total": 0})
+    results.put(
+        {
+            "wall_time": round(wall_time, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "queries": queries["count"],
+            "query_time": queries["total"],
+            "counters": summary["counters"],
+        }
+    )
+
+
+def run_in_process(settings_dir, scenario, api_url):
+    """Runs a scenario in a new process started in settings_dir.
+
+    Returns:
+        dict: measurements from run_scenario
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_scenario, args=(scenario, api_url, results))
+    cwd = os.getcwd()
+    os.chdir(settings_dir)
+    try:
+        process.start()
+    finally:
+        os.chdir(cwd)
+    result = results.get()
+    process.join()
+    return result
+
+
+def git_commit():
+    """Gets the current commit, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    """Runs every scenario for every catalog size.
+
+    Returns:
+        list: one result per size and scenario
+    """
+    results = []
+    for size in args.sizes:
+        with TemporaryDirectory() as settings_dir:
+            db_url = args.db_url.format(books=size, dir=settings_dir)
+            generate_time = generate_catalog(db_url, size)
+            print(f"Generated {size} books in {generate_time:.1f}s")
+            write_settings(settings_dir, db_url, args.workers)
+            # half the kbart rows are already in the catalog
+            write_kbart(
+                Path(settings_dir, "kbart.txt"),
+                range(size - args.kbart_rows // 2, size + args.kbart_rows // 2),
+            )
+            # api books come after the kbart books, so they are all new
+            with MockBookmetaServer(
+                size + args.kbart_rows, args.api_records, args.latency
+            ) as server:
+                for scenario in args.scenarios:
+                    result = run_in_process(settings_dir, scenario, server.url)
+                    result.update({"scenario": scenario, "books": size})
+                    print(
+                        f"{scenario:<8}{size:>10} books {result['wall_time']:>10.2f}s "
+                        f"{result['peak_rss_mb']:>10.1f} MB "
+                        f"{result['queries']:>8} queries"
+                    )
+                    results.append(result)
+    return results
+
+
+def compare(results, previous_path):
+    """Prints the change in wall time and peak RSS from earlier results."""
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+    previous_results = {(r["scenario"], r["books"]): r for r in previous["results"]}
+    print(f"\nCompared with {previous.get('commit')}:")
+    for result in results:
+        before = previous_results.get((result["scenario"], result["books"]))
+        if not before:
+            continue
+        print(
+            f"{result['scenario']:<8}{result['books']:>10} books "
+            f"time {result['wall_time'] / before['wall_time']:>6.2f}x "
+            f"memory {result['peak_rss_mb'] / before['peak_rss_mb']:>6.2f}x "
+            f"queries {before['queries']} -> {result['queries']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[2:]),
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000])
+    parser.add_argument(
+        "--db-url",
+        default="sqlite:///{dir}/catalog_{books}.db",
+        help="Catalog database URL; {books} and {dir}, a temporary directory, "
+        "are filled in. The database must be empty.",
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--api-records", type=int, default=1000)
+    parser.add_argument("--kbart-rows", type=int, default=1000)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Mock API latency in seconds."
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Results file of an earlier run.")
+    args = parser.parse_args()
+    results = run_benchmarks(args)
+    with open(args.output, "w") as output_file:
+        json.dump(
+            {
+                "commit": git_commit(),
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "settings": {
+                    "api_records": args.api_records,
+                    "kbart_rows": args.kbart_rows,
+                    "latency": args.latency,
+                    "workers": args.workers,
+                },
+                "results": results,
+            },
+            output_file,
+            indent=4,
+        )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
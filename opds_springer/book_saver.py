@@ -1,19 +1,102 @@
+import json
 import logging
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from csv import QUOTE_NONE, DictReader
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from hashlib import sha256
+from itertools import islice
+from random import uniform
+from threading import Lock
+from time import monotonic, perf_counter, sleep
 
 import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import bindparam, select
 
-from .books_db import Book, Link, Subject, session
+from .books_db import Book, Checkpoint, Link, Session, Subject, association_table
+from .metrics import metrics
+from .response_cache import ResponseCache
 
 
 class APIException(Exception):
     pass
 
 
+def chunks(iterable, size):
+    """Splits an iterable into lists of at most size items.
+
+    Args:
+        iterable (iterable): items to split
+        size (int): maximum items per list
+
+    Yields:
+        list: items
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def book_fingerprint(book_data):
+    """Hashes the data a book is saved from, to find books that have changed.
+
+    Links and subjects are sorted first, so that their order does not matter.
+
+    Args:
+        book_data (dict): book, link and subject data for one book
+
+    Returns:
+        str: sha256 hex digest
+    """
+    normalized = {
+        "book": {k: v for k, v in book_data["book"].items() if k != "fingerprint"},
+        "links": sorted(list(link) for link in book_data["links"]),
+        "subjects": sorted(set(book_data["subjects"] or [])),
+    }
+    return sha256(
+        json.dumps(normalized, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def api_book_data(record):
+    """Formats a Springer API record as the data a book is saved from.
+
+    Args:
+        record (dict): Springer API book record
+
+    Returns:
+        dict: book, link and subject data for one book
+    """
+    return {
+        "book": {
+            "book_id": record["doi"],
+            "title": record["publicationName"],
+            "print_isbn": record["printIsbn"],
+            "ebook_isbn": record["electronicIsbn"],
+            "publisher": record["publisherName"],
+            "series_id": record.get("seriesId"),
+            "language": record["language"],
+            "description": record["abstract"],
+            "published": record["publicationDate"],
+            "authors": SpringerClient.parse_contributors(
+                record.get("creators"), "creator"
+            ),
+            "editors": SpringerClient.parse_contributors(
+                record.get("bookEditors"), "bookEditor"
+            ),
+        },
+        "links": SpringerClient.get_links(record),
+        "subjects": record["subjects"],
+    }
+
+
 class BookData(object):
-    def __init__(self):
+    def __init__(self, use_cache=True):
         logging.basicConfig(
             datefmt="%m/%d/%Y %I:%M:%S %p",
             filename=datetime.now().strftime("book_saver_%Y%m%d.log"),
@@ -25,131 +108,640 @@ class BookData(object):
         self.api_key = self.config.get("Springer", "api_key")
         self.entitlement_id = self.config.get("Springer", "entitlement")
         self.kbart_file = self.config.get("Springer", "kbart_path")
-        self.springer_client = SpringerClient(self.api_key, self.entitlement_id)
+        self.fetch_workers = self.config.getint("Springer", "fetch_workers", fallback=1)
+        self.page_workers = self.config.getint("Springer", "page_workers", fallback=1)
+        self.batch_size = self.config.getint("Database", "batch_size", fallback=500)
+        cache_path = self.config.get("Springer", "cache_path", fallback=None)
+        self.response_cache = None
+        if use_cache and cache_path:
+            self.response_cache = ResponseCache(
+                cache_path,
+                ttl=self.config.getfloat("Springer", "cache_ttl", fallback=86400),
+                max_size=self.config.getfloat("Springer", "cache_max_mb", fallback=256),
+            )
+        self.springer_client = SpringerClient(
+            self.api_key,
+            self.entitlement_id,
+            rate_limit=self.config.getfloat("Springer", "rate_limit", fallback=0),
+            max_retries=self.config.getint("Springer", "max_retries", fallback=5),
+            backoff=self.config.getfloat("Springer", "backoff", fallback=1),
+            timeout=self.config.getfloat("Springer", "timeout", fallback=60),
+            pool_size=max(self.fetch_workers * self.page_workers, 10),
+            page_workers=self.page_workers,
+            cache=self.response_cache,
+        )
 
-    def save_books_from_api(self, days=30):
+    def save_books_from_api(self, days=30, resume=False):
         """Saves books from Springer API loaded after x days ago.
 
+        Saved books are updated if their Springer data has changed.
+
         Args:
             days (int): number of days ago to load from
+            resume (bool): continue the last unfinished run from its checkpoint
+        instead of starting a new one
         """
         from_date = (date.today() - timedelta(days=days)).isoformat()
-        recent_books = self.springer_client.books_loaded_from(from_date)
-        for record in recent_books:
+        checkpoint = self.get_checkpoint("api", from_date, resume)
+        recent_books = self.springer_client.books_loaded_from(
+            from_date, start=checkpoint.position + 1
+        )
+        self.save_books(self.api_books(recent_books, checkpoint.position), checkpoint)
+
+    def save_books_from_kbart(self, fetch_workers=None, resume=False):
+        """Saves books from a kbart file to database.
+
+        Supplements kbart data with data from Springer API. The file is read in
+        chunks of batch_size rows, and each chunk is written in one transaction,
+        so memory use does not grow with the size of the file.
+
+        Args:
+            fetch_workers (int): number of threads requesting Springer API data.
+        Defaults to fetch_workers in the Springer config section.
+            resume (bool): continue the last unfinished run from its checkpoint
+        instead of starting a new one
+
+        Returns:
+            int: number of books saved
+        """
+        fetch_workers = fetch_workers or self.fetch_workers
+        checkpoint = self.get_checkpoint("kbart", str(self.kbart_file), resume)
+        total_rows = sum(1 for _ in self.parse_kbart_tsv()) - checkpoint.position
+        kbart_rows = self.number_rows(self.parse_kbart_tsv(), checkpoint.position)
+        self.subject_cache = SubjectCache(Session)
+        start_time = perf_counter()
+        rows_done = 0
+        saved = 0
+        for row_chunk, books in self.kbart_chunks(kbart_rows, fetch_workers):
+            position = row_chunk[-1]["row_number"]
+            if books:
+                saved += self.write_batch(books, checkpoint, position)
+            else:
+                self.save_checkpoint(checkpoint, position)
+            rows_done += len(row_chunk)
+            self.log_progress(rows_done, total_rows, start_time)
+        self.save_checkpoint(checkpoint, completed=True)
+        logging.info(f"Saved {saved} books from {rows_done} kbart rows")
+        if self.response_cache:
+            self.response_cache.log_stats()
+        return saved
+
+    def log_progress(self, rows_done, total_rows, start_time):
+        """Logs the rate of an ingest run and its estimated time remaining.
+
+        Args:
+            rows_done (int): number of rows handled
+            total_rows (int): number of rows in the run
+            start_time (float): perf_counter at the start of the run
+        """
+        elapsed = perf_counter() - start_time
+        rate = rows_done / elapsed if elapsed else 0
+        remaining = (total_rows - rows_done) / rate if rate else 0
+        logging.info(
+            f"{rows_done} of {total_rows} kbart rows, {rate:.1f} rows/sec, "
+            f"ETA {timedelta(seconds=round(remaining))}"
+        )
+
+    def get_checkpoint(self, source, query, resume=False):
+        """Gets a checkpoint for an ingest run.
+
+        Only an unfinished run of the same query is resumed. A new run
+        supersedes the unfinished runs of its source, so they are not resumed
+        later.
+
+        Args:
+            source (str): api or kbart
+            query (str): from date or kbart path of the run
+            resume (bool): get the last unfinished checkpoint for the source and
+        query, if there is one, instead of starting a new one
+
+        Returns:
+            obj: Checkpoint record
+        """
+        unfinished = Session.query(Checkpoint).filter_by(
+            source=source, completed=False, superseded=False
+        )
+        checkpoint = None
+        if resume:
+            checkpoint = (
+                unfinished.filter_by(query=query)
+                .order_by(Checkpoint.checkpoint_id.desc())
+                .first()
+            )
+            if not checkpoint:
+                logging.info(f"No unfinished {source} ingest of {query} to resume")
+        if checkpoint:
+            logging.info(
+                f"Resuming {source} ingest of {checkpoint.query} "
+                f"after {checkpoint.position} records"
+            )
+        else:
+            superseded = unfinished.update(
+                {"superseded": True}, synchronize_session=False
+            )
+            if superseded:
+                logging.info(f"Superseded {superseded} unfinished {source} ingests")
+            checkpoint = Checkpoint(source=source, query=query, position=0)
+            Session.add(checkpoint)
+            Session.commit()
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint, position=None, completed=False):
+        """Records progress of an ingest run.
+
+        Args:
+            checkpoint (obj): Checkpoint record
+            position (int): number of records or rows handled
+            completed (bool): whether the run has finished
+        """
+        if position is not None:
+            checkpoint.position = position
+        checkpoint.completed = completed
+        with metrics.timer("db.commit"):
+            Session.commit()
+
+    def number_rows(self, kbart_rows, start=0):
+        """Adds a row_number to kbart rows, skipping rows up to start.
+
+        Args:
+            kbart_rows (iterable): rows from parse_kbart_tsv
+            start (int): number of rows to skip
+
+        Yields:
+            dict: row data with row_number
+        """
+        for row_number, kbart_row in enumerate(
+            islice(kbart_rows, start, None), start=start + 1
+        ):
+            kbart_row["row_number"] = row_number
+            yield kbart_row
+
+    def api_books(self, records, start=0):
+        """Formats Springer API records.
+
+        Args:
+            records (iterable): Springer API book records
+            start (int): number of records handled before the first record
+
+        Yields:
+            dict: book, link and subject data for one book
+        """
+        for position, record in enumerate(records, start=start + 1):
             try:
-                book_id = record["doi"]
-                if not session.get(Book, book_id):
-                    logging.info(f"Saving {book_id}...")
-                    links = self.springer_client.get_links(record)
-                    book = Book(
-                        book_id=book_id,
-                        title=record["publicationName"],
-                        print_isbn=record["printIsbn"],
-                        ebook_isbn=record["electronicIsbn"],
-                        publisher=record["publisherName"],
-                        series_id=record.get("seriesId"),
-                        language=record["language"],
-                        description=record["abstract"],
-                        published=record["publicationDate"],
-                        authors=self.springer_client.parse_contributors(
-                            record.get("creators"), "creator"
-                        ),
-                        editors=self.springer_client.parse_contributors(
-                            record.get("bookEditors"), "bookEditor"
-                        ),
-                    )
-                    for pub_type, link in links:
-                        new_link = Link(pub_type=pub_type, href=link)
-                        book.links.append(new_link)
-                    for subject in record["subjects"]:
-                        if (
-                            session.query(Subject)
-                            .filter_by(subject=subject, source="springer")
-                            .first()
-                        ):
-                            subject_record = (
-                                session.query(Subject)
-                                .filter_by(subject=subject, source="springer")
-                                .first()
-                            )
-                            book.subjects.append(subject_record)
-                        else:
-                            new_subject = Subject(subject=subject, source="springer")
-                            session.add(new_subject)
-                            subject_record = (
-                                session.query(Subject)
-                                .filter_by(subject=subject, source="springer")
-                                .first()
-                            )
-                            book.subjects.append(subject_record)
-                    session.add(book)
-                    session.commit()
-            except APIException as e:
-                logging.error(e)
-                pass
+                yield dict(api_book_data(record), position=position)
             except Exception as e:
                 logging.error(e)
-                pass
 
-    def save_books_from_kbart(self):
-        """Saves books from a kbart file to database.
+    def kbart_chunks(self, kbart_rows, fetch_workers=1):
+        """Splits kbart rows into chunks with book data for their unsaved books.
+
+        Rows for saved books are skipped before the Springer API is called.
+        Springer API data for a chunk is requested in lookups of
+        SpringerClient.LOOKUP_SIZE DOIs by a thread pool, and is fetched for the
+        next chunk while the caller writes the current one. Database queries
+        stay on the calling thread.
 
-        Supplements kbart data with data from Springer API.
+        Args:
+            kbart_rows (iterable): rows from number_rows
+            fetch_workers (int): number of threads requesting Springer API data
+
+        Yields:
+            tuple: list of kbart rows, and list of book, link and subject data
+        for the rows that are not saved yet
         """
-        kbart_rows = self.parse_kbart_tsv()
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            pending = deque()
+            pending_ids = set()
+            for row_chunk in chunks(kbart_rows, self.batch_size):
+                unsaved_rows = self.unsaved_kbart_rows(row_chunk, pending_ids)
+                futures = [
+                    executor.submit(self.fetch_springer_data, lookup)
+                    for lookup in chunks(unsaved_rows, self.springer_client.LOOKUP_SIZE)
+                ]
+                pending.append((row_chunk, unsaved_rows, futures))
+                if len(pending) > 1:
+                    yield self.chunk_books(*pending.popleft(), pending_ids)
+            while pending:
+                yield self.chunk_books(*pending.popleft(), pending_ids)
+
+    def unsaved_kbart_rows(self, kbart_rows, pending_ids):
+        """Filters out kbart rows for saved books with one query.
+
+        Args:
+            kbart_rows (list): rows from number_rows
+            pending_ids (set): ids of books that are about to be saved, updated
+        with each returned row
+
+        Returns:
+            list: rows that are not saved or pending
+        """
+        book_ids = [row["title_id"] for row in kbart_rows if row.get("title_id")]
+        saved_ids = set(
+            Session.execute(
+                select(Book.book_id).where(Book.book_id.in_(book_ids))
+            ).scalars()
+        )
+        unsaved_rows = []
         for kbart_row in kbart_rows:
-            try:
-                book_id = kbart_row["title_id"]
-                if not session.get(Book, book_id):
-                    logging.info(f"Saving {book_id}...")
-                    springer_data = self.springer_client.supplement_book_data(book_id)
-                    book = Book(
-                        book_id=book_id,
-                        title=kbart_row["publication_title"],
-                        print_isbn=kbart_row["print_identifier"],
-                        ebook_isbn=kbart_row["online_identifier"],
-                        publisher=kbart_row["publisher_name"],
-                        series_id=kbart_row["parent_publication_title_id"],
-                        language=springer_data["language"],
-                        description=springer_data["description"],
-                        published=springer_data["publication_date"],
+            book_id = kbart_row.get("title_id")
+            if book_id and book_id not in saved_ids and book_id not in pending_ids:
+                pending_ids.add(book_id)
+                unsaved_rows.append(kbart_row)
+        return unsaved_rows
+
+    def chunk_books(self, row_chunk, unsaved_rows, futures, pending_ids):
+        """Combines the unsaved rows of a chunk with their Springer API data.
+
+        Args:
+            row_chunk (list): rows from number_rows
+            unsaved_rows (list): rows from unsaved_kbart_rows
+            futures (list): futures of fetch_springer_data for unsaved_rows
+            pending_ids (set): ids of books that are about to be saved, which
+        the ids of this chunk are removed from
+
+        Returns:
+            tuple: row_chunk, and list of book, link and subject data
+        """
+        springer_data = {}
+        for future in futures:
+            springer_data.update(future.result())
+        books = []
+        for kbart_row in unsaved_rows:
+            book_id = kbart_row["title_id"]
+            pending_ids.discard(book_id)
+            if book_id in springer_data:
+                try:
+                    books.append(
+                        self.kbart_book_data(kbart_row, springer_data[book_id])
                     )
-                    if springer_data.get("authors"):
-                        book.authors = springer_data["authors"]
-                    if springer_data.get("editors"):
-                        book.authors = springer_data["editors"]
-                    for pub_type, link in springer_data["links"]:
-                        new_link = Link(pub_type=pub_type, href=link)
-                        book.links.append(new_link)
-                    for subject in springer_data["subjects"]:
-                        if (
-                            session.query(Subject)
-                            .filter_by(subject=subject, source="springer")
-                            .first()
-                        ):
-                            subject_record = (
-                                session.query(Subject)
-                                .filter_by(subject=subject, source="springer")
-                                .first()
-                            )
-                            book.subjects.append(subject_record)
-                        else:
-                            new_subject = Subject(subject=subject, source="springer")
-                            session.add(new_subject)
-                            subject_record = (
-                                session.query(Subject)
-                                .filter_by(subject=subject, source="springer")
-                                .first()
-                            )
-                            book.subjects.append(subject_record)
-                    session.add(book)
-                    session.commit()
-            except APIException as e:
-                logging.error(e)
-                pass
+                except Exception as e:
+                    logging.error(e)
+        return row_chunk, books
+
+    def fetch_springer_data(self, kbart_rows):
+        """Gets Springer API data for kbart rows.
+
+        Args:
+            kbart_rows (list): rows from parse_kbart_tsv
+
+        Returns:
+            dict: data from SpringerClient.format_book_data keyed on title_id.
+        Books that could not be retrieved are left out.
+        """
+        try:
+            records = self.springer_client.request_books(
+                [kbart_row["title_id"] for kbart_row in kbart_rows]
+            )
+        except Exception as e:
+            logging.error(e)
+            return {}
+        springer_data = {}
+        for doi, record in records.items():
+            if record:
+                try:
+                    springer_data[doi] = self.springer_client.format_book_data(record)
+                except Exception as e:
+                    logging.error(f"{doi}: {e}")
+        return springer_data
+
+    def kbart_book_data(self, kbart_row, springer_data):
+        """Combines a kbart row with supplemental Springer API data.
+
+        Args:
+            kbart_row (dict): row from parse_kbart_tsv
+            springer_data (dict): data from SpringerClient.supplement_book_data
+
+        Returns:
+            dict: book, link and subject data for one book
+        """
+        return {
+            "book": {
+                "book_id": kbart_row["title_id"],
+                "title": kbart_row["publication_title"],
+                "print_isbn": kbart_row["print_identifier"],
+                "ebook_isbn": kbart_row["online_identifier"],
+                "publisher": kbart_row["publisher_name"],
+                "series_id": kbart_row["parent_publication_title_id"],
+                "language": springer_data["language"],
+                "description": springer_data["description"],
+                "published": springer_data["publication_date"],
+                "authors": springer_data.get("authors"),
+                "editors": springer_data.get("editors"),
+            },
+            "links": springer_data["links"],
+            "subjects": springer_data["subjects"],
+            "position": kbart_row.get("row_number"),
+        }
+
+    def save_books(self, books, checkpoint=None):
+        """Saves books to the database in batches of batch_size.
+
+        Args:
+            books (iterable): book data from api_books
+            checkpoint (obj): Checkpoint record updated after each batch
+
+        Returns:
+            int: number of books saved
+        """
+        self.subject_cache = SubjectCache(Session)
+        start_time = perf_counter()
+        saved = 0
+        batch = {}
+        for book_data in books:
+            batch[book_data["book"]["book_id"]] = book_data
+            if len(batch) >= self.batch_size:
+                saved += self.write_batch(list(batch.values()), checkpoint)
+                batch = {}
+        if batch:
+            saved += self.write_batch(list(batch.values()), checkpoint)
+        if checkpoint:
+            self.save_checkpoint(checkpoint, completed=True)
+        elapsed = perf_counter() - start_time
+        rate = saved / elapsed if elapsed else 0
+        logging.info(f"Saved {saved} books in {elapsed:.1f}s ({rate:.1f} books/sec)")
+        if self.response_cache:
+            self.response_cache.log_stats()
+        return saved
+
+    def write_batch(self, batch, checkpoint=None, position=None):
+        """Writes a batch of books in one transaction.
+
+        If the batch fails, its books are retried one at a time so that one bad
+        record does not lose the rest of the batch.
+
+        Args:
+            batch (list): book data dicts
+            checkpoint (obj): Checkpoint record moved to the end of the batch
+            position (int): checkpoint position after the batch. Defaults to
+        the position of the last book.
+
+        Returns:
+            int: number of books added or updated
+        """
+        if position is None:
+            position = batch[-1]["position"]
+        try:
+            saved = self.upsert_books(batch)
+            if checkpoint:
+                checkpoint.position = position
+            with metrics.timer("db.commit"):
+                Session.commit()
+            return saved
+        except Exception as e:
+            logging.error(f"Batch of {len(batch)} books failed, retrying: {e}")
+            self.rollback()
+        saved = 0
+        for book_data in batch:
+            try:
+                saved += self.upsert_books([book_data])
+                with metrics.timer("db.commit"):
+                    Session.commit()
             except Exception as e:
-                logging.error(e)
-                pass
+                logging.error(f"{book_data['book']['book_id']}: {e}")
+                self.rollback()
+        if checkpoint:
+            self.save_checkpoint(checkpoint, position)
+        return saved
+
+    def upsert_books(self, batch):
+        """Adds new books and updates books whose data has changed.
+
+        Fingerprints of the batch are compared with the saved fingerprints in
+        one query, and unchanged books are left alone. Books saved before
+        fingerprints were added are compared with their stored data instead,
+        and only given a fingerprint if it matches.
+
+        Args:
+            batch (list): book data dicts
+
+        Returns:
+            int: number of books added or updated
+        """
+        for book_data in batch:
+            book_data["book"]["fingerprint"] = book_fingerprint(book_data)
+        saved_fingerprints = dict(
+            Session.execute(
+                select(Book.book_id, Book.fingerprint).where(
+                    Book.book_id.in_([b["book"]["book_id"] for b in batch])
+                )
+            ).all()
+        )
+        unfingerprinted = [
+            b
+            for b in batch
+            if b["book"]["book_id"] in saved_fingerprints
+            and saved_fingerprints[b["book"]["book_id"]] is None
+        ]
+        unchanged_ids = set()
+        if unfingerprinted:
+            unchanged_ids = self.stored_unchanged(unfingerprinted)
+            self.backfill_fingerprints(
+                [b for b in unfingerprinted if b["book"]["book_id"] in unchanged_ids]
+            )
+        new_books = []
+        changed_books = []
+        for book_data in batch:
+            book = book_data["book"]
+            if book["book_id"] not in saved_fingerprints:
+                new_books.append(book_data)
+            elif (
+                book["fingerprint"] != saved_fingerprints[book["book_id"]]
+                and book["book_id"] not in unchanged_ids
+            ):
+                changed_books.append(book_data)
+        if new_books:
+            self.insert_books(new_books)
+        if changed_books:
+            self.update_books(changed_books)
+        metrics.count("books.added", len(new_books))
+        metrics.count("books.updated", len(changed_books))
+        if new_books or changed_books:
+            logging.info(
+                f"Added {len(new_books)} and updated {len(changed_books)} books"
+            )
+        return len(new_books) + len(changed_books)
+
+    def stored_unchanged(self, batch):
+        """Finds saved books whose stored row, links and subjects match their data.
+
+        Args:
+            batch (list): book data dicts of saved books
+
+        Returns:
+            set: ids of the unchanged books
+        """
+        book_ids = [b["book"]["book_id"] for b in batch]
+        book_table = Book.__table__
+        columns = [c for c in batch[0]["book"] if c != "fingerprint"]
+        stored_books = {
+            row.book_id: row
+            for row in Session.execute(
+                select(*[book_table.c[c] for c in columns]).where(
+                    book_table.c.book_id.in_(book_ids)
+                )
+            )
+        }
+        stored_links = defaultdict(set)
+        for book_id, pub_type, href in Session.execute(
+            select(Link.book_id, Link.pub_type, Link.href).where(
+                Link.book_id.in_(book_ids)
+            )
+        ):
+            stored_links[book_id].add((pub_type, href))
+        stored_subjects = defaultdict(set)
+        for book_id, subject in Session.execute(
+            select(association_table.c.book_id, Subject.subject)
+            .join(Subject, Subject.subject_id == association_table.c.subject_id)
+            .where(association_table.c.book_id.in_(book_ids))
+        ):
+            stored_subjects[book_id].add(subject)
+        unchanged_ids = set()
+        for book_data in batch:
+            book = book_data["book"]
+            stored_book = stored_books[book["book_id"]]
+            # compared as strings, since the data may have a string where the
+            # column is an integer
+            if (
+                all(str(getattr(stored_book, c)) == str(book[c]) for c in columns)
+                and stored_links[book["book_id"]]
+                == {tuple(link) for link in book_data["links"]}
+                and stored_subjects[book["book_id"]] == set(book_data["subjects"] or [])
+            ):
+                unchanged_ids.add(book["book_id"])
+        return unchanged_ids
+
+    def backfill_fingerprints(self, batch):
+        """Saves the fingerprints of unchanged books without setting modified.
+
+        Args:
+            batch (list): book data dicts with fingerprints
+        """
+        if not batch:
+            return
+        book_table = Book.__table__
+        Session.execute(
+            book_table.update()
+            .where(book_table.c.book_id == bindparam("b_book_id"))
+            .values(
+                fingerprint=bindparam("b_fingerprint"),
+                # set to itself so that its onupdate does not run
+                modified=book_table.c.modified,
+            ),
+            [
+                {
+                    "b_book_id": b["book"]["book_id"],
+                    "b_fingerprint": b["book"]["fingerprint"],
+                }
+                for b in batch
+            ],
+        )
+        logging.info(f"Added fingerprints to {len(batch)} unchanged books")
+
+    def update_books(self, batch):
+        """Updates saved books, and only the links and subjects that changed.
+
+        Updating a book sets its modified time. Its created time, and so its
+        place in the feed, stays the same.
+
+        Args:
+            batch (list): book data dicts
+        """
+        book_ids = [b["book"]["book_id"] for b in batch]
+        book_table = Book.__table__
+        Session.execute(
+            book_table.update().where(book_table.c.book_id == bindparam("b_book_id")),
+            [
+                dict(
+                    {k: v for k, v in b["book"].items() if k != "book_id"},
+                    b_book_id=b["book"]["book_id"],
+                )
+                for b in batch
+            ],
+        )
+        saved_links = {}
+        for link_id, book_id, pub_type, href in Session.execute(
+            select(Link.id, Link.book_id, Link.pub_type, Link.href).where(
+                Link.book_id.in_(book_ids)
+            )
+        ):
+            saved_links[(book_id, pub_type, href)] = link_id
+        saved_subjects = set(
+            Session.execute(
+                select(
+                    association_table.c.book_id, association_table.c.subject_id
+                ).where(association_table.c.book_id.in_(book_ids))
+            ).all()
+        )
+        links = set()
+        subjects = set()
+        for book_data in batch:
+            book_id = book_data["book"]["book_id"]
+            for pub_type, href in book_data["links"]:
+                links.add((book_id, pub_type, href))
+            for subject_id in self.subject_cache.resolve(book_data["subjects"]):
+                subjects.add((book_id, subject_id))
+        removed_links = [
+            {"link_id": link_id}
+            for link, link_id in saved_links.items()
+            if link not in links
+        ]
+        if removed_links:
+            Session.execute(
+                Link.__table__.delete().where(Link.id == bindparam("link_id")),
+                removed_links,
+            )
+        added_links = [
+            {"book_id": book_id, "pub_type": pub_type, "href": href}
+            for book_id, pub_type, href in links - saved_links.keys()
+        ]
+        if added_links:
+            Session.execute(Link.__table__.insert(), added_links)
+        removed_subjects = [
+            {"b_book_id": book_id, "b_subject_id": subject_id}
+            for book_id, subject_id in saved_subjects - subjects
+        ]
+        if removed_subjects:
+            association = association_table.c
+            Session.execute(
+                association_table.delete().where(
+                    association.book_id == bindparam("b_book_id"),
+                    association.subject_id == bindparam("b_subject_id"),
+                ),
+                removed_subjects,
+            )
+        added_subjects = [
+            {"book_id": book_id, "subject_id": subject_id}
+            for book_id, subject_id in subjects - saved_subjects
+        ]
+        if added_subjects:
+            Session.execute(association_table.insert(), added_subjects)
+
+    def insert_books(self, batch):
+        """Inserts books with their links and subjects using executemany.
+
+        Args:
+            batch (list): book data dicts
+        """
+        link_rows = []
+        subject_rows = []
+        for book_data in batch:
+            book_id = book_data["book"]["book_id"]
+            for pub_type, href in book_data["links"]:
+                link_rows.append(
+                    {"book_id": book_id, "pub_type": pub_type, "href": href}
+                )
+            for subject_id in self.subject_cache.resolve(book_data["subjects"]):
+                subject_rows.append({"book_id": book_id, "subject_id": subject_id})
+        Session.execute(Book.__table__.insert(), [b["book"] for b in batch])
+        if link_rows:
+            Session.execute(Link.__table__.insert(), link_rows)
+        if subject_rows:
+            Session.execute(association_table.insert(), subject_rows)
+
+    def rollback(self):
+        """Rolls back the session and reloads the subject cache."""
+        Session.rollback()
+        self.subject_cache.load()
 
     def parse_kbart_tsv(self):
         """Parses a kbart tsv file as a dictionary.
@@ -166,42 +758,228 @@ class BookData(object):
                 yield row
 
 
+class SubjectCache(object):
+    def __init__(self, db_session):
+        self.session = db_session
+        self.subjects = {}
+        self.load()
+
+    def load(self):
+        """Loads the ids of all saved subjects, keyed on subject and source."""
+        self.subjects = {
+            (s.subject, s.source): s.subject_id
+            for s in self.session.query(Subject).all()
+        }
+
+    def resolve(self, subjects, source="springer"):
+        """Gets subject ids, adding any subjects that are not saved yet.
+
+        Missing subjects are added in bulk and flushed so that their subject_id
+        is known.
+
+        Args:
+            subjects (list): subject names
+            source (str): source of the subject names
+
+        Returns:
+            list: unique subject_ids, in the same order as subjects
+        """
+        subjects = list(dict.fromkeys(subjects))
+        missing = [s for s in subjects if (s, source) not in self.subjects]
+        if missing:
+            new_subjects = [Subject(subject=s, source=source) for s in missing]
+            self.session.add_all(new_subjects)
+            self.session.flush()
+            for new_subject in new_subjects:
+                self.subjects[(new_subject.subject, source)] = new_subject.subject_id
+        return [self.subjects[(subject, source)] for subject in subjects]
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst=1):
+        """Token bucket that allows rate requests per second.
+
+        Args:
+            rate (float): requests per second
+            burst (int): requests allowed at once after an idle period
+        """
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """Blocks until a request can be made."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait:
+            sleep(wait)
+
+
 class SpringerClient(object):
     BASE_URL = "https://spdi.public.springernature.app/bookmeta/v1/json"
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    PAGE_LENGTH = 100
+    LOOKUP_SIZE = 100
+    MAX_QUERY_LENGTH = 4000
+    MAX_BACKOFF = 120
+
+    def __init__(
+        self,
+        api_key,
+        entitlement_id,
+        rate_limit=0,
+        max_retries=5,
+        backoff=1,
+        timeout=60,
+        pool_size=10,
+        page_workers=1,
+        cache=None,
+    ):
+        """Client for the Springer bookmeta API.
 
-    def __init__(self, api_key, entitlement_id):
+        Args:
+            api_key (str): Springer API key
+            entitlement_id (str): Springer entitlement id
+            rate_limit (float): maximum requests per second, or 0 for no limit
+            max_retries (int): retries for throttled, failed or timed out requests
+            backoff (float): seconds to wait before the first retry, doubled
+        for each retry after that
+            timeout (float): seconds to wait for a response
+            pool_size (int): number of kept-alive connections
+            page_workers (int): number of result pages requested at a time
+            cache (obj): ResponseCache for API responses, or None
+        """
         self.api_key = api_key
         self.entitlement_id = entitlement_id
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.page_workers = page_workers
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, params):
+        """Requests the Springer API, retrying throttled and failed requests.
+
+        Retries wait for the server's Retry-After header if there is one, and
+        otherwise for an exponential backoff with jitter.
+
+        Args:
+            params (dict): query parameters
+
+        Returns:
+            obj: requests Response
+
+        Raises:
+            requests.RequestException: if the request fails after all retries
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                with metrics.timer("api.request"):
+                    response = self.session.get(
+                        self.BASE_URL, params=params, timeout=self.timeout
+                    )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+            else:
+                if (
+                    response.status_code not in self.RETRY_STATUSES
+                    or attempt == self.max_retries
+                ):
+                    response.raise_for_status()
+                    metrics.count("api.pages")
+                    return response
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+            metrics.count("api.retries")
+            logging.warning(
+                f"Springer API request failed, retrying in {delay:.1f}s "
+                f"({attempt + 1}/{self.max_retries})"
+            )
+            sleep(delay)
+
+    def get_json(self, params):
+        """Gets the JSON data of a Springer API response, using the cache if set.
+
+        Args:
+            params (dict): query parameters
+
+        Returns:
+            dict: response data
+        """
+        if self.cache:
+            data = self.cache.get(params)
+            if data is not None:
+                metrics.count("api.cache_hits")
+                return data
+        data = self.get(params).json()
+        if self.cache:
+            self.cache.set(params, data)
+        return data
+
+    def backoff_delay(self, attempt):
+        """Gets an exponential backoff delay with jitter.
+
+        Args:
+            attempt (int): number of the failed attempt, starting at 0
+
+        Returns:
+            float: seconds to wait
+        """
+        delay = min(self.MAX_BACKOFF, self.backoff * 2**attempt)
+        return delay / 2 + uniform(0, delay / 2)
+
+    def retry_after(self, response):
+        """Gets the delay requested by a Retry-After header.
+
+        Args:
+            response (obj): requests Response
+
+        Returns:
+            float: seconds to wait, or None if there is no valid header
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
 
-    def books_loaded_from(self, date_string):
+    def books_loaded_from(self, date_string, start=1):
         """Gets book data from the Springer API for books added since a date.
 
         Args:
             date_string (str): date to start from, formatted YYYY-MM-DD
+            start (int): offset of the first record to get, starting at 1
+
+        Yields:
+            dict: main book information
         """
-        page_length = 100
         try:
-            params = {
-                "q": f"dateloadedfrom:{date_string}",
-                "p": page_length,
-                "api_key": self.api_key,
-                "entitlement": self.entitlement_id,
-                "s": 1,
-            }
-            response = requests.get(self.BASE_URL, params=params)
-            response.raise_for_status()
-            total_results = int(response.json()["result"][0]["total"])
-            if total_results <= page_length:
-                for record in response.json()["records"]:
-                    yield record
-            else:
-                start = 1
-                while response.json().get("nextPage"):
-                    params["s"] = start
-                    response = requests.get(self.BASE_URL, params=params)
-                    for record in response.json()["records"]:
-                        yield record
-                    start += page_length
+            yield from self.search(f"dateloadedfrom:{date_string}", start)
         except Exception as err:
             raise APIException(err)
 
@@ -215,7 +993,17 @@ class SpringerClient(object):
         Returns:
             dict: data about a book
         """
-        record = self.request_book(doi)
+        return self.format_book_data(self.request_book(doi))
+
+    def format_book_data(self, record):
+        """Formats book data from a Springer API record.
+
+        Args:
+            record (dict): main book information
+
+        Returns:
+            dict: data about a book
+        """
         book_data = {
             "language": record["language"],
             "description": record["abstract"],
@@ -227,6 +1015,136 @@ class SpringerClient(object):
         }
         return book_data
 
+    def request_books(self, dois):
+        """Gets the JSON records for many books using as few requests as possible.
+
+        DOIs are combined into OR'd queries by doi_queries and each query's
+        results are paged through.
+
+        Args:
+            dois (list): identifiers of books to retrieve. May or may not include
+        "doi:" at beginning of identifiers
+
+        Returns:
+            dict: main book information keyed on each DOI as given, or None for
+        DOIs that were not found in the API
+        """
+        requested = {self.normalize_doi(doi): doi for doi in dois}
+        records = dict.fromkeys(dois)
+        for query in self.doi_queries(requested):
+            for record in self.search(query):
+                doi = requested.get(self.normalize_doi(record.get("doi", "")))
+                if doi:
+                    records[doi] = record
+        missing = [doi for doi, record in records.items() if record is None]
+        if missing:
+            logging.error(f"Not found in API: {', '.join(missing)}")
+        return records
+
+    def doi_queries(self, dois):
+        """Combines DOIs into OR'd queries.
+
+        Each query has at most LOOKUP_SIZE DOIs and MAX_QUERY_LENGTH characters.
+
+        Args:
+            dois (iterable): identifiers without "doi:" at beginning
+
+        Yields:
+            str: query
+        """
+        terms = []
+        length = 2
+        for doi in dois:
+            term = f"doi:{doi}"
+            if terms and (
+                len(terms) >= self.LOOKUP_SIZE
+                or length + len(term) + 4 > self.MAX_QUERY_LENGTH
+            ):
+                yield f"({' OR '.join(terms)})"
+                terms = []
+                length = 2
+            terms.append(term)
+            length += len(term) + 4
+        if terms:
+            yield f"({' OR '.join(terms)})"
+
+    def search(self, query, start=1):
+        """Gets all records matching a query.
+
+        The first page gives the total number of results, so the offsets of the
+        remaining pages are known and they are fetched by fetch_pages.
+
+        Args:
+            query (str): Springer API query
+            start (int): offset of the first record to get, starting at 1
+
+        Yields:
+            dict: main book information
+        """
+        page_data = self.get_page(query, start)
+        yield from page_data["records"]
+        total_results = int(page_data["result"][0]["total"])
+        starts = range(start + self.PAGE_LENGTH, total_results + 1, self.PAGE_LENGTH)
+        for page_data in self.fetch_pages(query, starts):
+            yield from page_data["records"]
+
+    def fetch_pages(self, query, starts):
+        """Gets pages of results for a query, in order.
+
+        With more than one page worker, up to page_workers pages are requested
+        at a time in a thread pool.
+
+        Args:
+            query (str): Springer API query
+            starts (iterable): offsets of the pages to get
+
+        Yields:
+            dict: page data
+        """
+        if self.page_workers <= 1:
+            for start in starts:
+                yield self.get_page(query, start)
+            return
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            pending = deque()
+            for start in starts:
+                pending.append(executor.submit(self.get_page, query, start))
+                if len(pending) >= self.page_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def get_page(self, query, start):
+        """Gets one page of results for a query.
+
+        Args:
+            query (str): Springer API query
+            start (int): offset of the first record on the page, starting at 1
+
+        Returns:
+            dict: page data
+        """
+        params = {
+            "q": query,
+            "p": self.PAGE_LENGTH,
+            "api_key": self.api_key,
+            "entitlement": self.entitlement_id,
+            "s": start,
+        }
+        return self.get_json(params)
+
+    def normalize_doi(self, doi):
+        """Removes "doi:" from the beginning of a DOI and lowercases it.
+
+        Args:
+            doi (str): identifier of a book
+
+        Returns:
+            str: normalized DOI
+        """
+        doi = doi[4:] if doi.startswith("doi:") else doi
+        return doi.lower()
+
     def request_book(self, doi):
         """Gets and formats the JSON response for the Springer single book endpoint.
 
@@ -245,9 +1163,7 @@ class SpringerClient(object):
                 "api_key": self.api_key,
                 "entitlement": self.entitlement_id,
             }
-            response = requests.get(self.BASE_URL, params=params)
-            response.raise_for_status()
-            page_data = response.json()
+            page_data = self.get_json(params)
             if page_data["records"]:
                 return page_data["records"][0]
             else:
@@ -255,7 +1171,8 @@ class SpringerClient(object):
         except Exception as err:
             raise Exception(err)
 
-    def parse_contributors(self, list_of_contributors, contributor_type):
+    @staticmethod
+    def parse_contributors(list_of_contributors, contributor_type):
         """Gets a list of creators or editors.
 
         Args:
@@ -268,7 +1185,8 @@ class SpringerClient(object):
         if list_of_contributors:
             return "|".join([c[contributor_type] for c in list_of_contributors])
 
-    def get_links(self, record):
+    @staticmethod
+    def get_links(record):
         """Gets links to media formats.
 
         Args:
@@ -1,23 +1,118 @@
 from configparser import ConfigParser
+from threading import Lock
 
 from sqlalchemy import (
+    Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    MetaData,
     String,
     Table,
+    bindparam,
     create_engine,
+    event,
+    inspect,
+    select,
 )
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import func
 
+from .metrics import instrument_engine
+
 config = ConfigParser()
 config.read("local_settings.cfg")
-db_url = config.get("Database", "db")
 
-engine = create_engine(db_url)
+# applied to every new SQLite connection; set a pragma to an empty value in
+# [Database] to leave the SQLite default
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": "-65536",
+    "mmap_size": "268435456",
+    "temp_store": "MEMORY",
+}
+
+
+def engine_options():
+    """Gets create_engine arguments from the [Database] section.
+
+    Pool options are only passed when they are set, since in-memory SQLite
+    databases use a pool that does not accept a size.
+
+    Returns:
+        dict: keyword arguments for create_engine
+    """
+    options = {}
+    for option in ("pool_size", "max_overflow", "pool_recycle"):
+        if config.has_option("Database", option):
+            options[option] = config.getint("Database", option)
+    if config.has_option("Database", "pool_pre_ping"):
+        options["pool_pre_ping"] = config.getboolean("Database", "pool_pre_ping")
+    return options
+
+
+def sqlite_pragmas():
+    """Gets the pragmas to set on SQLite connections.
+
+    Returns:
+        dict: pragma values by name
+    """
+    pragmas = {
+        name: config.get("Database", name, fallback=value)
+        for name, value in SQLITE_PRAGMAS.items()
+    }
+    return {name: value for name, value in pragmas.items() if value}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Sets the configured pragmas on a new SQLite connection.
+
+    Args:
+        dbapi_connection (Connection): sqlite3 connection
+        connection_record (obj): pool record of the connection
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas().items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def create_db_engine(url):
+    """Creates a database engine with the configured pool and pragmas.
+
+    SQLite file databases get a QueuePool instead of SQLAlchemy's default
+    NullPool, so that connections are reused with their pragmas and page cache
+    rather than opened for every transaction. Queries run by the engine are
+    timed in metrics.
+
+    Args:
+        url (str): SQLAlchemy URL of the database
+
+    Returns:
+        Engine: database engine
+    """
+    options = engine_options()
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database not in (
+        None,
+        "",
+        ":memory:",
+    ):
+        options["poolclass"] = QueuePool
+        # pooled connections are used by whichever thread checks them out
+        options["connect_args"] = {"check_same_thread": False}
+    db_engine = create_engine(url, **options)
+    if db_engine.dialect.name == "sqlite":
+        event.listen(db_engine, "connect", set_sqlite_pragmas)
+    instrument_engine(db_engine)
+    return db_engine
+
 
 Base = declarative_base()
 
@@ -25,13 +120,14 @@ Base = declarative_base()
 association_table = Table(
     "association_table",
     Base.metadata,
-    Column("book_id", ForeignKey("book.book_id")),
-    Column("subject_id", ForeignKey("subject.subject_id")),
+    Column("book_id", ForeignKey("book.book_id"), primary_key=True),
+    Column("subject_id", ForeignKey("subject.subject_id"), primary_key=True),
 )
 
 
 class Book(Base):
     __tablename__ = "book"
+    __table_args__ = (Index("ix_book_created_book_id", "created", "book_id"),)
 
     book_id = Column(String(length=50), primary_key=True)
     title = Column(String(length=256))
@@ -45,10 +141,16 @@ class Book(Base):
     authors = Column(String(length=256))
     editors = Column(String(length=256))
     subjects = relationship("Subject", secondary=association_table)
-    links = relationship("Link", backref="book")
+    links = relationship("Link", backref="book", cascade="save-update, merge, expunge")
     modified = Column(
         DateTime(), server_default=func.now(), onupdate=func.current_timestamp()
     )
+    # set when the book is first saved and never changed, so the feed can be
+    # ordered by it; a client default too, since a column added by
+    # upgrade_schema has no server default
+    created = Column(DateTime(), default=func.now(), server_default=func.now())
+    # sha256 of the book, link and subject data the book was saved from
+    fingerprint = Column(String(length=64))
 
 
 class Link(Base):
@@ -58,19 +160,199 @@ class Link(Base):
     rel = Column(String(length=256), default="http://opds-spec.org/acquisition")
     pub_type = Column(String(length=50))
     href = Column(String(length=256))
-    book_id = Column(String(length=50), ForeignKey("book.book_id"))
+    book_id = Column(String(length=50), ForeignKey("book.book_id"), index=True)
 
 
 class Subject(Base):
     __tablename__ = "subject"
+    __table_args__ = (
+        Index("ix_subject_subject_source", "subject", "source", unique=True),
+    )
 
     subject_id = Column(Integer(), primary_key=True)
     subject = Column(String(length=256))
     source = Column(String(length=50))
 
 
-Base.metadata.create_all(engine)
+class Checkpoint(Base):
+    __tablename__ = "checkpoint"
+
+    checkpoint_id = Column(Integer(), primary_key=True)
+    source = Column(String(length=50))
+    query = Column(String(length=256))
+    position = Column(Integer(), default=0)
+    completed = Column(Boolean(), default=False)
+    # set when a new run of the same source starts before this one finished
+    superseded = Column(Boolean(), default=False)
+    modified = Column(
+        DateTime(), server_default=func.now(), onupdate=func.current_timestamp()
+    )
+
+
+def dedupe_subjects(connection):
+    """Merges subjects saved more than once with the same name and source.
+
+    Books are moved to the subject with the lowest subject_id.
+
+    Args:
+        connection (Connection): database connection
+    """
+    subject_ids = {}
+    duplicates = []
+    rows = connection.execute(
+        select(Subject.subject_id, Subject.subject, Subject.source).order_by(
+            Subject.subject_id
+        )
+    )
+    for subject_id, subject, source in rows:
+        kept_id = subject_ids.setdefault((subject, source), subject_id)
+        if kept_id != subject_id:
+            duplicates.append({"duplicate_id": subject_id, "kept_id": kept_id})
+    if duplicates:
+        association = association_table.c
+        connection.execute(
+            association_table.update()
+            .where(association.subject_id == bindparam("duplicate_id"))
+            .values(subject_id=bindparam("kept_id")),
+            duplicates,
+        )
+        connection.execute(
+            Subject.__table__.delete().where(
+                Subject.subject_id == bindparam("duplicate_id")
+            ),
+            duplicates,
+        )
+
+
+def rebuild_association_table(connection):
+    """Recreates association_table with its primary key.
+
+    SQLite cannot add a primary key to an existing table, so the rows are
+    copied to a new table, leaving out duplicates.
+
+    Args:
+        connection (Connection): database connection
+    """
+    connection.exec_driver_sql(
+        "ALTER TABLE association_table RENAME TO association_table_old"
+    )
+    old_table = Table(
+        "association_table_old",
+        MetaData(),
+        Column("book_id", String(length=50)),
+        Column("subject_id", Integer()),
+    )
+    association_table.create(connection)
+    connection.execute(
+        association_table.insert().from_select(
+            ["book_id", "subject_id"],
+            select(old_table.c.book_id, old_table.c.subject_id)
+            .where(old_table.c.book_id.isnot(None))
+            .where(old_table.c.subject_id.isnot(None))
+            .distinct(),
+        )
+    )
+    old_table.drop(connection)
+
+
+def upgrade_schema(engine):
+    """Brings a database created by an earlier version up to the current schema.
+
+    Creates missing tables, columns and indexes, merges duplicate subjects so
+    that they can be indexed as unique, and adds the association_table primary
+    key. It does nothing for a database that is already up to date.
+
+    Args:
+        engine (Engine): database engine
+    """
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    subject_indexes = {index["name"] for index in inspector.get_indexes("subject")}
+    association_key = inspector.get_pk_constraint("association_table")
+    book_columns = {column["name"] for column in inspector.get_columns("book")}
+    book_indexes = {index["name"] for index in inspector.get_indexes("book")}
+    checkpoint_columns = {c["name"] for c in inspector.get_columns("checkpoint")}
+    with engine.begin() as connection:
+        if "fingerprint" not in book_columns:
+            connection.exec_driver_sql(
+                "ALTER TABLE book ADD COLUMN fingerprint VARCHAR(64)"
+            )
+        if "created" not in book_columns:
+            connection.exec_driver_sql("ALTER TABLE book ADD COLUMN created DATETIME")
+            # keeps the order of the published feed; modified is set too so
+            # that its onupdate does not change it
+            book = Book.__table__.c
+            connection.execute(
+                Book.__table__.update().values(
+                    created=book.modified, modified=book.modified
+                )
+            )
+        if "ix_book_modified_book_id" in book_indexes:
+            connection.exec_driver_sql("DROP INDEX ix_book_modified_book_id")
+        if "superseded" not in checkpoint_columns:
+            connection.exec_driver_sql(
+                "ALTER TABLE checkpoint ADD COLUMN superseded BOOLEAN"
+            )
+            connection.execute(Checkpoint.__table__.update().values(superseded=False))
+        if "ix_subject_subject_source" not in subject_indexes:
+            dedupe_subjects(connection)
+        if not association_key["constrained_columns"]:
+            rebuild_association_table(connection)
+        # create_all only adds indexes to new tables
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+# created on first use by get_engine, so that importing this module does not
+# connect to the database
+engine = None
+engine_lock = Lock()
+
+
+def get_engine():
+    """Gets the database engine, creating it from the db URL on first use.
+
+    Returns:
+        Engine: database engine
+    """
+    global engine
+    with engine_lock:
+        if engine is None:
+            engine = create_db_engine(config.get("Database", "db"))
+        return engine
+
+
+def bind_engine(db_engine):
+    """Uses another engine for new sessions.
+
+    Closes the sessions of the current engine. Used by tests and by processes
+    that need their own connections.
+
+    Args:
+        db_engine (Engine): database engine, or None to create one from the db
+    URL on next use
+    """
+    global engine
+    Session.remove()
+    with engine_lock:
+        engine = db_engine
+
+
+def create_schema():
+    """Creates the database tables, or upgrades them to the current schema."""
+    upgrade_schema(get_engine())
+
 
 session_maker = sessionmaker()
-session_maker.configure(bind=engine)
-session = session_maker()
+# one session per thread, bound to the engine when it is first used
+Session = scoped_session(lambda: session_maker(bind=get_engine()))
+
+
+def get_session():
+    """Gets the database session of the current thread.
+
+    Returns:
+        Session: database session
+    """
+    return Session()
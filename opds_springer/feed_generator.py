@@ -1,13 +1,148 @@
+import gzip
 import json
 import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime
+from functools import partial
+from io import BytesIO
 from math import ceil
 from pathlib import Path
 
-from sqlalchemy import desc, select
+from sqlalchemy import String, select, tuple_, type_coerce
+from sqlalchemy.orm import selectinload
 
-from .books_db import Book, session
+from .books_db import Book, Session, bind_engine, create_db_engine, get_engine
+from .metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def encode_json(data, indent=True):
+    """Encodes data as JSON, using orjson if it is installed.
+
+    The standard library is used with orjson's formatting, two-space indents and
+    unescaped UTF-8, so that a page encodes to the same bytes either way and
+    installing orjson does not rewrite every page.
+
+    Args:
+        data (dict): data to encode
+        indent (bool): whether to indent the output
+
+    Returns:
+        bytes: UTF-8 encoded JSON
+    """
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode()
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def write_file(path, data):
+    """Writes a file through a synced temporary file, so it is never partly written.
+
+    Args:
+        path (obj): Path of the file
+        data (bytes): file contents
+    """
+    temp_path = path.with_name(f".{path.name}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def link_file(source, path):
+    """Hard links a file, if it exists and the file system allows it.
+
+    Args:
+        source (obj): Path of the existing file
+        path (obj): Path of the new link
+
+    Returns:
+        bool: whether the file was linked
+    """
+    try:
+        os.link(source, path)
+        return True
+    except OSError:
+        return False
+
+
+def gzip_compress(data):
+    """Compresses data with gzip.
+
+    The timestamp is left out so that the same data always compresses to the
+    same bytes. GzipFile is used since gzip.compress only takes mtime from
+    Python 3.8.
+
+    Args:
+        data (bytes): data to compress
+
+    Returns:
+        bytes: gzip data
+    """
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def brotli_compress(data, quality=4):
+    """Compresses data with brotli.
+
+    The default quality is much faster than brotli's default of 11, which takes
+    seconds for a 1,000-book page, for files about 10% larger.
+
+    Args:
+        data (bytes): data to compress
+        quality (int): brotli quality, from 0 to 11
+
+    Returns:
+        bytes: brotli data
+    """
+    return brotli.compress(data, quality=quality)
+
+
+COMPRESSORS = {"gzip": (".gz", gzip_compress), "br": (".br", brotli_compress)}
+
+
+def sync_directory(path):
+    """Flushes a directory's entries to disk.
+
+    Args:
+        path (obj): Path of the directory
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def init_worker(db_url):
+    """Gives a page-writing process its own database session.
+
+    Args:
+        db_url (obj): SQLAlchemy URL of the database
+    """
+    # the session inherited from the parent process is left unused, not closed
+    Session.registry.clear()
+    bind_engine(create_db_engine(db_url))
+    # metrics copied from the parent process were already counted there
+    metrics.reset()
 
 
 class GenerateFeed(object):
@@ -25,40 +160,252 @@ class GenerateFeed(object):
         self.base_url = self.config.get("Feed", "base_url")
         self.feed_base_name = "_".join(self.feed_title.lower().split(" "))
         self.page_size = 1000
+        self.workers = self.config.getint("Feed", "workers", fallback=1)
+        self.indent = self.config.getboolean("Feed", "indent", fallback=True)
+        self.keep_versions = self.config.getint("Feed", "keep_versions", fallback=3)
+        self.compressors = []
+        for name in self.config.get("Feed", "precompress", fallback="").split(","):
+            name = name.strip()
+            if name == "br" and not brotli:
+                logging.warning(
+                    "brotli is not installed, .br files will not be written"
+                )
+            elif name == "br":
+                quality = self.config.getint("Feed", "brotli_quality", fallback=4)
+                self.compressors.append(
+                    (".br", partial(brotli_compress, quality=quality))
+                )
+            elif name in COMPRESSORS:
+                self.compressors.append(COMPRESSORS[name])
+
+    def opds_feed(self, workers=None, page_hook=None):
+        """Creates a feed of OPDS data from saved books.
 
-    def opds_feed(self):
-        """Creates a feed of OPDS data from saved books."""
+        Args:
+            workers (int): number of processes writing pages. Defaults to workers
+        in the Feed config section.
+            page_hook (callable): called with the page number after each page is
+        written, for example to trace memory use
+        """
+        workers = workers or self.workers
         logging.info(f"Starting feed generation to {self.json_dir}")
-        self.total_pubs = session.query(Book).count()
+        self.total_pubs = Session.query(Book).count()
         logging.info(f"{self.total_pubs} publications will be in feed")
         self.total_pages = ceil(self.total_pubs / self.page_size)
-        books = self.get_books_from_db()
+        self.versions_dir = Path(
+            self.config.get("Feed", "versions_dir", fallback="")
+            or Path(self.json_dir).parent / f".{Path(self.json_dir).name}_versions"
+        )
+        self.previous_dir = (
+            Path(self.json_dir) if Path(self.json_dir).is_dir() else None
+        )
+        version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        self.output_dir = Path(self.versions_dir, f"{version}.partial")
+        self.output_dir.mkdir(parents=True)
+        if workers > 1:
+            pages_written = self.write_pages_in_parallel(workers, page_hook)
+        else:
+            pages_written = self.write_pages(page_hook)
+        logging.info(
+            f"{pages_written} of {self.total_pages} pages changed and were written"
+        )
+        self.publish(version)
+
+    def write_pages(self, page_hook=None):
+        """Writes all pages, reading one page of books at a time.
+
+        Args:
+            page_hook (callable): called with the page number after each page
+
+        Returns:
+            int: number of pages written
+        """
         logging.info("Retrieving books...")
-        count = 1
+        pages_written = 0
+        for page_number, books in self.iter_pages():
+            if self.write_page(page_number, books):
+                logging.info(f"Wrote page {page_number}")
+                pages_written += 1
+            if page_hook:
+                page_hook(page_number)
+        return pages_written
+
+    def write_pages_in_parallel(self, workers, page_hook=None):
+        """Writes pages in a pool of processes.
+
+        Each process reads the books for its page by keyset, starting after the
+        last book of the previous page.
+
+        Args:
+            workers (int): number of processes
+            page_hook (callable): called with the page number as each page is
+        finished, in this process
+
+        Returns:
+            int: number of pages written
+        """
+        if not self.total_pages:
+            return 0
+        after_keys = [None] + self.page_keys()
+        pages_written = 0
+        # pooled connections must not be inherited by the forked processes
+        Session.close()
+        get_engine().dispose()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(get_engine().url,),
+        ) as executor:
+            futures = [
+                executor.submit(self.write_page_after, page_number, after_key)
+                for page_number, after_key in enumerate(after_keys, start=1)
+            ]
+            for page_number, future in enumerate(futures, start=1):
+                written, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                if written:
+                    logging.info(f"Wrote page {page_number}")
+                    pages_written += 1
+                if page_hook:
+                    page_hook(page_number)
+        return pages_written
+
+    def write_page(self, page_number, books):
+        """Creates and writes one page of the feed.
+
+        Args:
+            page_number (int): page number
+            books (list): book records on the page
+
+        Returns:
+            bool: whether the file was written
+        """
         publications = []
-        page_number = 1
         for book in books:
-            book_json = BookOPDS().create_json(book)
-            publications.append(book_json)
-            if count % self.page_size == 0 or count == self.total_pubs:
-                opds_page = self.opds_page_data(page_number, publications)
-                opds_page["metadata"]["itemsPerPage"] = len(publications)
-                logging.info(f"Writing page {page_number}")
-                self.write_json(page_number, opds_page)
-                page_number += 1
-                publications = []
-            count += 1
+            publications.append(BookOPDS().create_json(book))
+            Session.expunge(book)
+        opds_page = self.opds_page_data(page_number, publications)
+        opds_page["metadata"]["itemsPerPage"] = len(publications)
+        return self.write_json(page_number, opds_page)
+
+    def write_page_after(self, page_number, after_key):
+        """Reads and writes one page of the feed on its own.
+
+        Args:
+            page_number (int): page number
+            after_key (tuple): sort key of the last book on the previous page,
+        or None for the first page
+
+        Returns:
+            tuple: whether the file was written, and the metrics collected in
+        the worker process since its last page
+        """
+        books, _ = self.get_page_books(after_key)
+        return self.write_page(page_number, books), metrics.collect()
+
+    def page_path(self, page_number, directory=None):
+        """Gets the path of a page file.
+
+        Args:
+            page_number (int): page number to append to end of filename
+            directory (obj): directory of the page. Defaults to json_dir.
+
+        Returns:
+            obj: Path of page file
+        """
+        return Path(
+            directory or self.json_dir, f"{self.feed_base_name}_{page_number}.json"
+        )
 
     def write_json(self, page_number, opds_page):
-        """Create JSON file.
+        """Create JSON file, and any precompressed copies, in the staging directory.
+
+        Files for a page with the same contents as in the published feed are
+        hard linked instead of written, so unchanged pages are left untouched.
 
         Args:
             page_number (int): page number to append to end of filename
             opds_page (dict): OPDS data to write
+
+        Returns:
+            bool: whether the page changed
+        """
+        with metrics.timer("feed.write_json"):
+            output_file = self.page_path(page_number, self.output_dir)
+            page_bytes = encode_json(opds_page, self.indent)
+            files = [(output_file, lambda: page_bytes)]
+            for extension, compress in self.compressors:
+                files.append(
+                    (Path(f"{output_file}{extension}"), partial(compress, page_bytes))
+                )
+            unchanged = False
+            if self.previous_dir:
+                previous_file = self.page_path(page_number, self.previous_dir)
+                unchanged = (
+                    previous_file.exists()
+                    and previous_file.stat().st_size == len(page_bytes)
+                    and previous_file.read_bytes() == page_bytes
+                )
+            for path, contents in files:
+                previous_path = unchanged and Path(self.previous_dir, path.name)
+                if not (previous_path and link_file(previous_path, path)):
+                    data = contents()
+                    write_file(path, data)
+                    metrics.count("feed.bytes_written", len(data))
+        metrics.count("feed.pages_unchanged" if unchanged else "feed.pages_changed")
+        return not unchanged
+
+    def publish(self, version):
+        """Publishes the staged pages as a new version of the feed.
+
+        json_dir is a symlink to the current version and is replaced in one
+        rename, so readers see either all old or all new pages. A json_dir that
+        is still a plain directory is first moved in with the other versions.
+
+        Args:
+            version (str): name of the new version
+        """
+        version_dir = Path(self.versions_dir, version)
+        sync_directory(self.output_dir)
+        os.replace(self.output_dir, version_dir)
+        json_dir = Path(self.json_dir)
+        if json_dir.is_dir() and not json_dir.is_symlink():
+            modified = datetime.fromtimestamp(json_dir.stat().st_mtime)
+            old_version_dir = Path(
+                self.versions_dir, modified.strftime("%Y%m%d%H%M%S%f")
+            )
+            logging.info(f"Moving {json_dir} to {old_version_dir}")
+            os.replace(json_dir, old_version_dir)
+        temp_link = json_dir.with_name(f".{json_dir.name}.tmp")
+        if temp_link.is_symlink():
+            temp_link.unlink()
+        os.symlink(os.path.relpath(version_dir, json_dir.parent), temp_link)
+        os.replace(temp_link, json_dir)
+        sync_directory(json_dir.parent)
+        logging.info(f"Published {json_dir} -> {version_dir}")
+        self.remove_old_versions(version_dir)
+
+    def remove_old_versions(self, current_dir):
+        """Deletes all but the newest keep_versions versions of the feed.
+
+        Staging directories left by runs that started before this one are
+        deleted too. Those of runs that started later may still be in use and
+        are left alone.
+
+        Args:
+            current_dir (obj): Path of the published version, which is never deleted
         """
-        output_file = Path(self.json_dir, f"{self.feed_base_name}_{page_number}.json")
-        with open(output_file, "w") as json_file:
-            json.dump(opds_page, json_file, indent=4)
+        version_dirs = sorted(p for p in self.versions_dir.iterdir() if p.is_dir())
+        complete_dirs = [p for p in version_dirs if p.suffix != ".partial"]
+        keep = {current_dir}
+        if self.keep_versions > 0:
+            keep.update(complete_dirs[-self.keep_versions :])
+        for version_dir in version_dirs:
+            if version_dir.suffix == ".partial" and version_dir.stem > current_dir.name:
+                continue
+            if version_dir not in keep:
+                logging.info(f"Removing old version {version_dir}")
+                shutil.rmtree(version_dir)
 
     def opds_page_data(self, page_number, publications):
         """Formats data for one OPDS response page.
@@ -70,13 +417,16 @@ class GenerateFeed(object):
         Returns:
             dict: OPDS response data
         """
+        metadata = {
+            "title": self.feed_title,
+            "itemsPerPage": self.page_size,
+            "currentPage": page_number,
+        }
+        # only the last page changes as books are added, so only it has the total
+        if page_number == self.total_pages:
+            metadata["numberOfItems"] = self.total_pubs
         return {
-            "metadata": {
-                "title": self.feed_title,
-                "itemsPerPage": self.page_size,
-                "currentPage": page_number,
-                "numberOfItems": self.total_pubs,
-            },
+            "metadata": metadata,
             "links": self.opds_response_links(page_number),
             "publications": publications,
         }
@@ -139,15 +489,66 @@ class GenerateFeed(object):
             "type": "application/opds+json",
         }
 
-    def get_books_from_db(self):
-        """Gets all book records.
+    def page_keys(self):
+        """Gets the sort keys of the last book on every page but the last.
+
+        Returns:
+            list: sort keys, tuples of created as stored and book_id
+        """
+        result = Session.execute(
+            select(type_coerce(Book.created, String), Book.book_id)
+            .order_by(Book.created, Book.book_id)
+            .execution_options(yield_per=self.page_size)
+        )
+        page_keys = []
+        for count, row in enumerate(result, start=1):
+            if count % self.page_size == 0 and count < self.total_pubs:
+                page_keys.append(tuple(row))
+        return page_keys
+
+    def iter_pages(self):
+        """Gets book records one page at a time.
+
+        Each page is read by keyset, starting after the last book of the
+        previous page, so reading a page does not depend on its position.
 
         Yields:
-            obj: book record
+            tuple: page number and list of book records
         """
-        result = session.execute(select(Book).order_by(desc(Book.modified)))
-        for book in result.all():
-            yield book[0]
+        after_key = None
+        for page_number in range(1, self.total_pages + 1):
+            books, after_key = self.get_page_books(after_key)
+            yield page_number, books
+
+    def get_page_books(self, after_key=None):
+        """Gets one page of book records.
+
+        Books are ordered by when they were first saved, so new books are added
+        to the end of the feed and earlier pages stay the same. Updating a book
+        changes its page, but not its place in the feed. The subjects and links
+        of the page are loaded together.
+
+        Args:
+            after_key (tuple): sort key of the last book on the previous page,
+        or None for the first page
+
+        Returns:
+            tuple: list of book records, and the sort key of the last one
+        """
+        # compare created as stored, since SQLite stores it as text that may
+        # or may not have microseconds
+        created = type_coerce(Book.created, String)
+        query = (
+            select(Book, created.label("created_key"))
+            .options(selectinload(Book.subjects), selectinload(Book.links))
+            .order_by(Book.created, Book.book_id)
+            .limit(self.page_size)
+        )
+        if after_key:
+            query = query.where(tuple_(created, Book.book_id) > tuple_(*after_key))
+        rows = Session.execute(query).all()
+        last_key = (rows[-1][1], rows[-1][0].book_id) if rows else None
+        return [row[0] for row in rows], last_key
 
 
 class BookOPDS(object):
@@ -160,12 +561,13 @@ class BookOPDS(object):
         Returns:
             dict: book data
         """
-        self.book = book
-        book_dict = {
-            "metadata": self.metadata(),
-            "images": self.images(),
-            "links": self.links(),
-        }
+        with metrics.timer("feed.create_json"):
+            self.book = book
+            book_dict = {
+                "metadata": self.metadata(),
+                "images": self.images(),
+                "links": self.links(),
+            }
         return book_dict
 
     def metadata(self):
@@ -0,0 +1,149 @@
+import json
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from time import perf_counter
+
+from sqlalchemy import event
+
+
+class Metrics(object):
+    def __init__(self):
+        """Timers and counters for one run, safe to update from any thread.
+
+        Timers record how many times something ran, its total and its longest
+        time. Counters record totals such as bytes written.
+        """
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all timers and counters and restarts the run clock."""
+        with self.lock:
+            self.started = datetime.now()
+            self.start_time = perf_counter()
+            self.timers = {}
+            self.counters = {}
+
+    def add_time(self, name, seconds):
+        """Records one timed event.
+
+        Args:
+            name (str): timer name
+            seconds (float): duration of the event
+        """
+        with self.lock:
+            count, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, value=1):
+        """Adds to a counter.
+
+        Args:
+            name (str): counter name
+            value (int): amount to add
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        """Times the body of a with statement.
+
+        Args:
+            name (str): timer name
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def collect(self):
+        """Gets and clears the timers and counters, to merge into another process.
+
+        Returns:
+            dict: timers and counters
+        """
+        with self.lock:
+            collected = {"timers": self.timers, "counters": self.counters}
+            self.timers = {}
+            self.counters = {}
+        return collected
+
+    def merge(self, collected):
+        """Adds timers and counters collected in another process.
+
+        Args:
+            collected (dict): data from collect
+        """
+        with self.lock:
+            for name, (count, total, longest) in collected["timers"].items():
+                saved = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (
+                    saved[0] + count,
+                    saved[1] + total,
+                    max(saved[2], longest),
+                )
+            for name, value in collected["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Summarizes the run.
+
+        Returns:
+            dict: start time, elapsed seconds, timers and counters
+        """
+        with self.lock:
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "elapsed": round(perf_counter() - self.start_time, 3),
+                "timers": {
+                    name: {
+                        "count": count,
+                        "total": round(total, 3),
+                        "mean": round(total / count, 6),
+                        "max": round(longest, 6),
+                    }
+                    for name, (count, total, longest) in sorted(self.timers.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def write_summary(self, path=None):
+        """Logs the run summary as JSON, and writes it to a file if path is set.
+
+        Args:
+            path (str): path of the JSON summary file
+        """
+        summary = self.summary()
+        logging.info(f"Run summary: {json.dumps(summary)}")
+        if path:
+            with open(path, "w") as summary_file:
+                json.dump(summary, summary_file, indent=4)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Records when a query starts."""
+    conn.info.setdefault("query_start_times", []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Records the time a query took."""
+    start = conn.info["query_start_times"].pop()
+    metrics.add_time("db.query", perf_counter() - start)
+
+
+def instrument_engine(db_engine):
+    """Times every query run by an engine as db.query.
+
+    Args:
+        db_engine (Engine): database engine
+    """
+    event.listen(db_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(db_engine, "after_cursor_execute", after_cursor_execute)
+
+
+# timers and counters of the current run
+metrics = Metrics()
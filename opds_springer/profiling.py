@@ -0,0 +1,76 @@
+import cProfile
+import logging
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# allocations by tracemalloc itself and the import system are left out
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+def log_top_allocations(label, limit=10):
+    """Logs the lines that allocated the most memory that is still in use.
+
+    Args:
+        label (str): where in the run the snapshot is taken
+        limit (int): number of lines to log
+    """
+    snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"Top allocations at {label}: {current / 1024 / 1024:.1f} MB current, "
+        f"{peak / 1024 / 1024:.1f} MB peak"
+    ]
+    for stat in snapshot.statistics("lineno")[:limit]:
+        lines.append(f"    {stat}")
+    logging.info("\n".join(lines))
+
+
+def log_page_allocations(page_number):
+    """Logs the top allocations after a feed page is written.
+
+    Args:
+        page_number (int): page number
+    """
+    log_top_allocations(f"page {page_number}")
+
+
+@contextmanager
+def profile_phase(phase, profile=False, trace_memory=False, output_dir="."):
+    """Profiles the body of a with statement, if asked to.
+
+    With profile, a cProfile of the phase is written to
+    <phase>_<timestamp>.pstats in output_dir. With trace_memory, memory
+    allocations are traced for the phase and the top allocation sites are logged
+    at its end. With neither, nothing is done.
+
+    Args:
+        phase (str): name of the phase
+        profile (bool): profile function calls with cProfile
+        trace_memory (bool): trace memory allocations with tracemalloc
+        output_dir (str): directory for .pstats files
+    """
+    profiler = None
+    if trace_memory:
+        tracemalloc.start()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            stats_path = Path(
+                output_dir, f"{phase}_{datetime.now():%Y%m%d_%H%M%S}.pstats"
+            )
+            profiler.dump_stats(stats_path)
+            logging.info(f"Wrote profile of {phase} to {stats_path}")
+        if trace_memory:
+            log_top_allocations(f"end of {phase}")
+            tracemalloc.stop()
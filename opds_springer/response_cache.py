@@ -0,0 +1,127 @@
+import json
+import logging
+import sqlite3
+from threading import Lock
+from time import time
+from urllib.parse import urlencode
+
+
+class ResponseCache(object):
+    def __init__(self, path, ttl=86400, max_size=256):
+        """SQLite-backed cache of Springer API responses.
+
+        Args:
+            path (str): path to the SQLite cache file
+            ttl (float): seconds a response stays valid
+            max_size (float): maximum size of cached responses in megabytes.
+        The least recently used responses are evicted beyond this size.
+        """
+        self.ttl = ttl
+        self.max_size = int(max_size * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS response (
+                key TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed)"
+        )
+        self.size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM response"
+        ).fetchone()[0]
+
+    def key(self, params):
+        """Creates a cache key from request parameters.
+
+        The API key is left out so that responses survive a key change.
+
+        Args:
+            params (dict): query parameters
+
+        Returns:
+            str: normalized query string
+        """
+        return urlencode(
+            sorted((k, str(v)) for k, v in params.items() if k != "api_key")
+        )
+
+    def get(self, params):
+        """Gets a cached response.
+
+        Args:
+            params (dict): query parameters
+
+        Returns:
+            dict: response data, or None if there is no valid cached response
+        """
+        key = self.key(params)
+        now = time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body, size, created FROM response WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[2] <= self.ttl:
+                self.connection.execute(
+                    "UPDATE response SET accessed = ? WHERE key = ?", (now, key)
+                )
+                self.hits += 1
+                return json.loads(row[0])
+            if row:
+                self.connection.execute("DELETE FROM response WHERE key = ?", (key,))
+                self.size -= row[1]
+            self.misses += 1
+
+    def set(self, params, data):
+        """Caches a response, evicting the least recently used responses if needed.
+
+        Args:
+            params (dict): query parameters
+            data (dict): response data
+        """
+        key = self.key(params)
+        body = json.dumps(data)
+        now = time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size FROM response WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                self.size -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)",
+                (key, body, len(body), now, now),
+            )
+            self.size += len(body)
+            while self.size > self.max_size:
+                oldest = self.connection.execute(
+                    "SELECT key, size FROM response WHERE key != ? "
+                    "ORDER BY accessed LIMIT 100",
+                    (key,),
+                ).fetchall()
+                if not oldest:
+                    break
+                evicted = []
+                for evicted_key, size in oldest:
+                    if self.size <= self.max_size:
+                        break
+                    evicted.append((evicted_key,))
+                    self.size -= size
+                self.connection.executemany(
+                    "DELETE FROM response WHERE key = ?", evicted
+                )
+
+    def log_stats(self):
+        """Logs cache hits and misses."""
+        logging.info(
+            f"Response cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.size / 1024 / 1024:.1f} MB cached"
+        )
@@ -1,20 +1,278 @@
 import json
 import unittest
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from random import random
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import monotonic, sleep
 from types import GeneratorType
 from unittest.mock import patch
 
 import responses
 from responses import matchers
+from sqlalchemy import create_engine, event, select, update
+from sqlalchemy.orm import sessionmaker
 
-from opds_springer.book_saver import BookData, SpringerClient
+from opds_springer.book_saver import (
+    APIException,
+    BookData,
+    RateLimiter,
+    SpringerClient,
+    SubjectCache,
+    api_book_data,
+)
+from opds_springer.books_db import (
+    Base,
+    Book,
+    Checkpoint,
+    Subject,
+    bind_engine,
+    create_db_engine,
+    get_session,
+)
+from opds_springer.metrics import metrics
+from opds_springer.response_cache import ResponseCache
 
 
 class TestBookData(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        bind_engine(engine)
+        self.addCleanup(bind_engine, None)
+        self.session = get_session()
+
     def test_init(self):
         book_data = BookData()
         self.assertTrue(book_data)
 
+    def test_save_books(self):
+        book_data = BookData()
+        book_data.batch_size = 2
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"][:5]
+        bad_record = dict(records[0], doi="10.1007/bad", subjects=None)
+        saved = book_data.save_books(book_data.api_books(records + [bad_record]))
+        self.assertEqual(saved, 5)
+        self.assertEqual(self.session.query(Book).count(), 5)
+        book = self.session.get(Book, records[0]["doi"])
+        self.assertEqual(len(book.links), len(api_book_data(records[0])["links"]))
+        self.assertEqual(len(book.subjects), len(set(records[0]["subjects"])))
+
+    def test_save_books_updates_changed(self):
+        book_data = BookData()
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"][:3]
+        self.assertEqual(book_data.save_books(book_data.api_books(records)), 3)
+        self.session.execute(
+            update(Book).values(
+                created=datetime(2020, 1, 1), modified=datetime(2020, 1, 1)
+            )
+        )
+        self.session.commit()
+        self.assertEqual(book_data.save_books(book_data.api_books(records)), 0)
+        changed_record = dict(
+            records[1],
+            publicationName="Corrected Title",
+            subjects=records[1]["subjects"][1:] + ["New Subject"],
+            url=[{"format": "epub", "value": "http://link.springer.com/epub"}],
+        )
+        saved = book_data.save_books(
+            book_data.api_books([records[0], changed_record, records[2]])
+        )
+        self.assertEqual(saved, 1)
+        self.session.expire_all()
+        changed_book = self.session.get(Book, records[1]["doi"])
+        self.assertEqual(changed_book.title, "Corrected Title")
+        self.assertEqual(
+            sorted(s.subject for s in changed_book.subjects),
+            sorted(set(changed_record["subjects"])),
+        )
+        self.assertEqual(
+            [(link.pub_type, link.href) for link in changed_book.links],
+            [("epub", "http://link.springer.com/epub")],
+        )
+        modified = dict(self.session.execute(select(Book.book_id, Book.modified)).all())
+        self.assertGreater(modified[records[1]["doi"]], datetime(2020, 1, 1))
+        self.assertEqual(modified[records[0]["doi"]], datetime(2020, 1, 1))
+        self.assertEqual(changed_book.created, datetime(2020, 1, 1))
+
+    def test_save_books_unfingerprinted(self):
+        book_data = BookData()
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"][:3]
+        book_data.save_books(book_data.api_books(records))
+        # books saved before fingerprints were added
+        self.session.execute(
+            update(Book).values(fingerprint=None, modified=datetime(2020, 1, 1))
+        )
+        self.session.commit()
+        changed_record = dict(records[1], publicationName="Corrected Title")
+        saved = book_data.save_books(
+            book_data.api_books([records[0], changed_record, records[2]])
+        )
+        self.assertEqual(saved, 1)
+        books = {
+            book_id: (fingerprint, modified)
+            for book_id, fingerprint, modified in self.session.execute(
+                select(Book.book_id, Book.fingerprint, Book.modified)
+            )
+        }
+        for record in (records[0], records[2]):
+            fingerprint, modified = books[record["doi"]]
+            self.assertIsNotNone(fingerprint)
+            self.assertEqual(modified, datetime(2020, 1, 1))
+        self.assertGreater(books[records[1]["doi"]][1], datetime(2020, 1, 1))
+        self.assertEqual(book_data.save_books(book_data.api_books(records)), 1)
+
+    def test_write_batch_reuses_connection(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        engine = create_db_engine(f"sqlite:///{temp_dir.name}/books.db")
+        self.addCleanup(engine.dispose)
+        connects = []
+        event.listen(engine, "connect", lambda *args: connects.append(args))
+        Base.metadata.create_all(engine)
+        bind_engine(engine)
+        book_data = BookData()
+        book_data.subject_cache = SubjectCache(get_session())
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"][:4]
+        book_data.write_batch(list(book_data.api_books(records[:2])))
+        book_data.write_batch(list(book_data.api_books(records[2:], start=2)))
+        self.assertEqual(get_session().query(Book).count(), 4)
+        self.assertEqual(len(connects), 1)
+
+    @responses.activate
+    def test_save_books_from_api_resume(self):
+        book_data = BookData()
+        book_data.batch_size = 2
+        book_data.springer_client = SpringerClient(
+            "api_key", "entitlement_id", max_retries=0
+        )
+        book_data.springer_client.PAGE_LENGTH = 2
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"][:5]
+
+        def add_page(start, status=200):
+            responses.get(
+                url="https://spdi.public.springernature.app/bookmeta/v1/json",
+                status=status,
+                json={
+                    "result": [{"total": "5"}],
+                    "records": records[start - 1 : start + 1],
+                },
+                match=[matchers.query_param_matcher({"s": start}, strict_match=False)],
+            )
+
+        add_page(1)
+        add_page(3, status=503)
+        with self.assertRaises(APIException):
+            book_data.save_books_from_api(7)
+        checkpoint = self.session.query(Checkpoint).one()
+        self.assertEqual((checkpoint.position, checkpoint.completed), (2, False))
+        responses.reset()
+        add_page(3)
+        add_page(5)
+        book_data.save_books_from_api(7, resume=True)
+        self.assertEqual(
+            [call.request.params["s"] for call in responses.calls], ["3", "5"]
+        )
+        self.assertEqual(self.session.query(Book).count(), 5)
+        checkpoint = self.session.query(Checkpoint).one()
+        self.assertEqual((checkpoint.position, checkpoint.completed), (5, True))
+
+    def test_get_checkpoint(self):
+        book_data = BookData()
+        old_run = book_data.get_checkpoint("api", "2026-09-18")
+        kbart_run = book_data.get_checkpoint("kbart", "kbart.txt")
+        new_run = book_data.get_checkpoint("api", "2026-10-17", resume=True)
+        self.assertNotEqual(new_run, old_run)
+        self.assertEqual(new_run.query, "2026-10-17")
+        self.assertTrue(old_run.superseded)
+        self.assertFalse(kbart_run.superseded)
+        self.assertEqual(
+            book_data.get_checkpoint("api", "2026-10-17", resume=True), new_run
+        )
+        self.assertEqual(
+            book_data.get_checkpoint("kbart", "kbart.txt", resume=True), kbart_run
+        )
+        self.assertNotEqual(
+            book_data.get_checkpoint("api", "2026-09-18", resume=True), old_run
+        )
+
+    def test_number_rows(self):
+        book_data = BookData()
+        book_data.kbart_file = Path("fixtures", "springer_kbart_example.txt")
+        kbart_rows = list(book_data.number_rows(book_data.parse_kbart_tsv(), 50))
+        self.assertEqual(len(kbart_rows), 1)
+        self.assertEqual(kbart_rows[0]["row_number"], 51)
+
+    def request_books(self, dois):
+        with open(Path("fixtures", "springer_book_example.json")) as f:
+            record = json.load(f)["records"][0]
+        sleep(random() / 100)
+        return {doi: dict(record, doi=doi) for doi in dois}
+
+    def kbart_book_data(self):
+        book_data = BookData(use_cache=False)
+        book_data.kbart_file = Path("fixtures", "springer_kbart_example.txt")
+        return book_data
+
+    @patch("opds_springer.book_saver.SpringerClient.request_books")
+    def test_kbart_chunks_skips_saved(self, mock_request_books):
+        mock_request_books.side_effect = self.request_books
+        book_data = self.kbart_book_data()
+        kbart_rows = list(book_data.number_rows(book_data.parse_kbart_tsv()))
+        self.session.add_all(Book(book_id=row["title_id"]) for row in kbart_rows[1:])
+        self.session.commit()
+        row_chunks = list(book_data.kbart_chunks(kbart_rows + kbart_rows[:1]))
+        self.assertEqual(len(row_chunks), 1)
+        row_chunk, books = row_chunks[0]
+        self.assertEqual(len(row_chunk), 52)
+        self.assertEqual(len(books), 1)
+        mock_request_books.assert_called_once_with([kbart_rows[0]["title_id"]])
+
+    @patch("opds_springer.book_saver.SpringerClient.request_books")
+    def test_kbart_chunks_not_found(self, mock_request_books):
+        mock_request_books.side_effect = lambda dois: dict.fromkeys(dois)
+        book_data = self.kbart_book_data()
+        row_chunks = list(book_data.kbart_chunks(book_data.parse_kbart_tsv()))
+        self.assertEqual([books for _, books in row_chunks], [[]])
+
+    @patch("opds_springer.book_saver.SpringerClient.request_books")
+    def test_kbart_chunks_concurrent(self, mock_request_books):
+        mock_request_books.side_effect = self.request_books
+        book_data = self.kbart_book_data()
+        book_data.batch_size = 20
+        book_data.springer_client.LOOKUP_SIZE = 5
+        serial_chunks = list(book_data.kbart_chunks(book_data.parse_kbart_tsv()))
+        concurrent_chunks = list(
+            book_data.kbart_chunks(book_data.parse_kbart_tsv(), fetch_workers=4)
+        )
+        self.assertEqual(mock_request_books.call_count, 22)
+        self.assertEqual([len(books) for _, books in serial_chunks], [20, 20, 11])
+        self.assertEqual(serial_chunks, concurrent_chunks)
+
+    @patch("opds_springer.book_saver.SpringerClient.request_books")
+    def test_save_books_from_kbart(self, mock_request_books):
+        mock_request_books.side_effect = self.request_books
+        book_data = self.kbart_book_data()
+        book_data.batch_size = 20
+        with self.assertLogs(level="INFO") as logs:
+            saved = book_data.save_books_from_kbart()
+        self.assertEqual(saved, 51)
+        progress = [line for line in logs.output if "rows/sec" in line]
+        self.assertEqual(len(progress), 3)
+        self.assertIn("51 of 51 kbart rows", progress[-1])
+        self.assertEqual(self.session.query(Book).count(), 51)
+        checkpoint = self.session.query(Checkpoint).one()
+        self.assertEqual((checkpoint.position, checkpoint.completed), (51, True))
+        self.assertEqual(book_data.save_books_from_kbart(), 0)
+        self.assertEqual(mock_request_books.call_count, 3)
+
     def test_parse_kbart_tsv(self):
         book_data = BookData()
         book_data.kbart_file = Path("fixtures", "springer_kbart_example.txt")
@@ -23,6 +281,35 @@ class TestBookData(unittest.TestCase):
         self.assertEqual(len([x for x in parsed_kbart]), 51)
 
 
+class TestSubjectCache(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.session.add(Subject(subject="Mathematics", source="springer"))
+        self.session.commit()
+
+    def test_resolve(self):
+        subject_cache = SubjectCache(self.session)
+        subject_ids = subject_cache.resolve(["Mathematics", "Physics", "Physics"])
+        subjects = [self.session.get(Subject, i).subject for i in subject_ids]
+        self.assertEqual(subjects, ["Mathematics", "Physics"])
+        self.assertEqual(self.session.query(Subject).count(), 2)
+
+    def test_resolve_queries(self):
+        subject_cache = SubjectCache(self.session)
+        statements = []
+        event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        for _ in range(10):
+            subject_cache.resolve(["Mathematics", "Physics"])
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("INSERT INTO subject"))
+
+
 class TestSpringerClient(unittest.TestCase):
     def test_init(self):
         springer_client = SpringerClient("api_key", "entitlement_id")
@@ -52,6 +339,25 @@ class TestSpringerClient(unittest.TestCase):
         first_book = next(book_data)
         print(first_book)
 
+    @responses.activate
+    def test_books_loaded_from_pages(self):
+        springer_client = SpringerClient("api_key", "entitlement_id", page_workers=3)
+        springer_client.PAGE_LENGTH = 2
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"][:5]
+        for start in (1, 3, 5):
+            responses.get(
+                url="https://spdi.public.springernature.app/bookmeta/v1/json",
+                json={
+                    "result": [{"total": "5"}],
+                    "records": records[start - 1 : start + 1],
+                },
+                match=[matchers.query_param_matcher({"s": start}, strict_match=False)],
+            )
+        book_data = list(springer_client.books_loaded_from("2023-08-11"))
+        self.assertEqual(book_data, records)
+        self.assertEqual(len(responses.calls), 3)
+
     @patch("opds_springer.book_saver.SpringerClient.request_book")
     def test_supplement_book_data(self, mock_book):
         springer_client = SpringerClient(
@@ -86,6 +392,49 @@ class TestSpringerClient(unittest.TestCase):
         requested_book = springer_client.request_book("doi:10.1007/978-1-349-11550-1")
         self.assertIsInstance(requested_book, dict)
 
+    @responses.activate
+    def test_request_books(self):
+        springer_client = SpringerClient("api_key", "entitlement_id")
+        with open(Path("fixtures", "springer_crawl_example.json")) as f:
+            records = json.load(f)["records"]
+        dois = [record["doi"] for record in records[:3]] + ["10.1007/missing"]
+        for start, page_records in ((1, records[:2]), (3, records[2:3])):
+            responses.get(
+                url="https://spdi.public.springernature.app/bookmeta/v1/json",
+                json={
+                    "result": [{"total": "3"}],
+                    "records": page_records,
+                },
+                match=[
+                    matchers.query_param_matcher(
+                        {
+                            "q": " OR ".join(f"doi:{doi}" for doi in dois).join("()"),
+                            "p": 2,
+                            "api_key": "api_key",
+                            "entitlement": "entitlement_id",
+                            "s": start,
+                        }
+                    )
+                ],
+            )
+        springer_client.PAGE_LENGTH = 2
+        requested_books = springer_client.request_books(dois)
+        self.assertEqual(list(requested_books), dois)
+        self.assertEqual(requested_books[dois[2]], records[2])
+        self.assertIsNone(requested_books["10.1007/missing"])
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_doi_queries(self):
+        springer_client = SpringerClient("api_key", "entitlement_id")
+        dois = [f"10.1007/978-3-031-{i:05}-3" for i in range(250)]
+        queries = list(springer_client.doi_queries(dois))
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(queries[0].startswith("(doi:10.1007/978-3-031-00000-3 OR "))
+        self.assertEqual(sum(query.count("doi:") for query in queries), 250)
+        springer_client.MAX_QUERY_LENGTH = 500
+        for query in springer_client.doi_queries(dois):
+            self.assertLessEqual(len(query), 500)
+
     def test_parse_contributors(self):
         list_of_creators = [{"creator": "Fultz, Brent"}, {"creator": "Howe, James"}]
         list_of_editors = []
@@ -98,3 +447,97 @@ class TestSpringerClient(unittest.TestCase):
         self.assertIsInstance(parsed_creators, str)
         self.assertTrue("Fultz, Brent" in parsed_creators)
         self.assertIsNone(parsed_editors)
+
+
+class StubSpringerHandler(BaseHTTPRequestHandler):
+    """Answers with the queued (status, headers) responses, then with 200."""
+
+    def do_GET(self):
+        self.server.requests.append(monotonic())
+        status, headers = (
+            self.server.responses.pop(0) if self.server.responses else (200, {})
+        )
+        body = json.dumps(self.server.body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSpringerClientRetries(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubSpringerHandler)
+        self.server.requests = []
+        self.server.responses = []
+        with open(Path("fixtures", "springer_book_example.json")) as f:
+            self.server.body = json.load(f)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def springer_client(self, **kwargs):
+        springer_client = SpringerClient("api_key", "entitlement_id", **kwargs)
+        springer_client.BASE_URL = f"http://127.0.0.1:{self.server.server_port}/"
+        return springer_client
+
+    def test_retry_on_server_error(self):
+        self.server.responses = [(503, {}), (500, {})]
+        springer_client = self.springer_client(backoff=0.01)
+        record = springer_client.request_book("10.1007/978-1-349-11550-1")
+        self.assertEqual(record["doi"], "10.1007/978-1-349-11550-1")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retry_after(self):
+        self.server.responses = [(429, {"Retry-After": "1"})]
+        springer_client = self.springer_client(backoff=0.01)
+        springer_client.request_book("10.1007/978-1-349-11550-1")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertGreaterEqual(self.server.requests[1] - self.server.requests[0], 1)
+
+    def test_retries_exhausted(self):
+        self.server.responses = [(503, {})] * 3
+        springer_client = self.springer_client(max_retries=2, backoff=0.01)
+        with self.assertRaises(Exception):
+            springer_client.request_book("10.1007/978-1-349-11550-1")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_metrics(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.server.responses = [(503, {})]
+        springer_client = self.springer_client(
+            backoff=0.01, cache=ResponseCache(Path(temp_dir.name, "cache.db"))
+        )
+        metrics.reset()
+        for _ in range(3):
+            springer_client.request_book("10.1007/978-1-349-11550-1")
+        self.assertEqual(
+            metrics.summary()["counters"],
+            {"api.cache_hits": 2, "api.pages": 1, "api.retries": 1},
+        )
+
+    def test_rate_limit(self):
+        springer_client = self.springer_client(rate_limit=20)
+        for _ in range(6):
+            springer_client.request_book("10.1007/978-1-349-11550-1")
+        self.assertGreaterEqual(
+            self.server.requests[-1] - self.server.requests[0], 0.25 - 0.01
+        )
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_acquire(self):
+        rate_limiter = RateLimiter(50, burst=5)
+        start = monotonic()
+        for _ in range(5):
+            rate_limiter.acquire()
+        self.assertLess(monotonic() - start, 0.05)
+        for _ in range(5):
+            rate_limiter.acquire()
+        self.assertGreaterEqual(monotonic() - start, 0.1 - 0.01)
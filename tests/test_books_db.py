@@ -0,0 +1,156 @@
+import unittest
+from configparser import ConfigParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+
+from benchmarks.bench_schema_indexes import OLD_SCHEMA
+from opds_springer.books_db import create_db_engine, engine_options, upgrade_schema
+
+
+class TestUpgradeSchema(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        with self.engine.begin() as connection:
+            for statement in OLD_SCHEMA:
+                connection.exec_driver_sql(statement)
+            connection.exec_driver_sql(
+                "INSERT INTO book (book_id, title) VALUES ('a', 'A'), ('b', 'B')"
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO subject VALUES (1, 'Mathematics', 'springer'), "
+                "(2, 'Physics', 'springer'), (3, 'Mathematics', 'springer'), "
+                "(4, 'Mathematics', 'kbart')"
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO association_table VALUES ('a', 1), ('a', 3), "
+                "('a', 2), ('b', 3), ('b', 4), ('b', 4)"
+            )
+
+    def association_rows(self):
+        with self.engine.connect() as connection:
+            return connection.exec_driver_sql(
+                "SELECT book_id, subject_id FROM association_table "
+                "ORDER BY book_id, subject_id"
+            ).all()
+
+    def test_upgrade_schema(self):
+        upgrade_schema(self.engine)
+        inspector = inspect(self.engine)
+        self.assertEqual(
+            inspector.get_pk_constraint("association_table")["constrained_columns"],
+            ["book_id", "subject_id"],
+        )
+        (subject_index,) = inspector.get_indexes("subject")
+        self.assertEqual(subject_index["name"], "ix_subject_subject_source")
+        self.assertEqual(subject_index["column_names"], ["subject", "source"])
+        self.assertTrue(subject_index["unique"])
+        link_indexes = [index["name"] for index in inspector.get_indexes("link")]
+        self.assertEqual(link_indexes, ["ix_link_book_id"])
+        self.assertIn("checkpoint", inspector.get_table_names())
+        book_columns = [column["name"] for column in inspector.get_columns("book")]
+        self.assertIn("fingerprint", book_columns)
+        with self.engine.connect() as connection:
+            subjects = connection.exec_driver_sql(
+                "SELECT subject_id FROM subject ORDER BY subject_id"
+            ).all()
+        self.assertEqual(subjects, [(1,), (2,), (4,)])
+        self.assertEqual(
+            self.association_rows(), [("a", 1), ("a", 2), ("b", 1), ("b", 4)]
+        )
+
+    def test_upgrade_schema_created(self):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE INDEX ix_book_modified_book_id ON book (modified, book_id)"
+            )
+            connection.exec_driver_sql(
+                "UPDATE book SET modified = '2020-01-01 00:00:00' WHERE book_id = 'a'"
+            )
+        upgrade_schema(self.engine)
+        book_indexes = [
+            index["name"] for index in inspect(self.engine).get_indexes("book")
+        ]
+        self.assertEqual(book_indexes, ["ix_book_created_book_id"])
+        with self.engine.connect() as connection:
+            books = connection.exec_driver_sql(
+                "SELECT book_id, created = modified, modified FROM book ORDER BY book_id"
+            ).all()
+        self.assertEqual([book[:2] for book in books], [("a", 1), ("b", 1)])
+        self.assertEqual(books[0][2], "2020-01-01 00:00:00")
+
+    def test_upgrade_schema_checkpoint(self):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("""CREATE TABLE checkpoint (
+                    checkpoint_id INTEGER NOT NULL,
+                    source VARCHAR(50),
+                    query VARCHAR(256),
+                    position INTEGER,
+                    completed BOOLEAN,
+                    modified DATETIME DEFAULT (CURRENT_TIMESTAMP),
+                    PRIMARY KEY (checkpoint_id)
+                )""")
+            connection.exec_driver_sql(
+                "INSERT INTO checkpoint (source, query, position, completed) "
+                "VALUES ('api', '2026-09-18', 200, 0)"
+            )
+        upgrade_schema(self.engine)
+        with self.engine.connect() as connection:
+            superseded = connection.exec_driver_sql(
+                "SELECT superseded FROM checkpoint"
+            ).scalar()
+        self.assertEqual(superseded, 0)
+
+    def test_upgrade_schema_twice(self):
+        upgrade_schema(self.engine)
+        upgrade_schema(self.engine)
+        self.assertEqual(len(self.association_rows()), 4)
+
+
+class TestCreateDbEngine(unittest.TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_url = f"sqlite:///{Path(temp_dir.name, 'test.db')}"
+        self.config = ConfigParser()
+        self.config.add_section("Database")
+        patcher = patch("opds_springer.books_db.config", self.config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_pragmas(self, db_engine):
+        with db_engine.connect() as connection:
+            return [
+                connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+                for name in ("journal_mode", "synchronous", "cache_size", "temp_store")
+            ]
+
+    def test_sqlite_pragmas(self):
+        db_engine = create_db_engine(self.db_url)
+        self.assertEqual(self.get_pragmas(db_engine), ["wal", 1, -65536, 2])
+
+    def test_sqlite_pragmas_config(self):
+        self.config.set("Database", "synchronous", "FULL")
+        self.config.set("Database", "journal_mode", "")
+        db_engine = create_db_engine(self.db_url)
+        self.assertEqual(self.get_pragmas(db_engine), ["delete", 2, -65536, 2])
+
+    def test_sqlite_pool(self):
+        self.config.set("Database", "pool_size", "2")
+        db_engine = create_db_engine(self.db_url)
+        self.assertIsInstance(db_engine.pool, QueuePool)
+        self.assertEqual(db_engine.pool.size(), 2)
+        self.assertIsInstance(create_db_engine("sqlite://").pool, SingletonThreadPool)
+
+    def test_engine_options(self):
+        self.assertEqual(engine_options(), {})
+        self.config.set("Database", "pool_size", "10")
+        self.config.set("Database", "max_overflow", "5")
+        self.config.set("Database", "pool_pre_ping", "true")
+        self.assertEqual(
+            engine_options(),
+            {"pool_size": 10, "max_overflow": 5, "pool_pre_ping": True},
+        )
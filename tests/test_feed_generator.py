@@ -1,17 +1,440 @@
+import gzip
+import json
+import tracemalloc
 import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
 from random import randint
+from tempfile import TemporaryDirectory
+from time import sleep
+from unittest.mock import patch
 
-from sqlalchemy import select
+from sqlalchemy import event, select, update
 
+from opds_springer import books_db, feed_generator
 from opds_springer.feed_generator import BookOPDS, GenerateFeed
 from tests.setup_db import Book, session
 
 
+def create_catalog(engine, count, subject_count=50):
+    """Fills a database with synthetic books, links and subjects."""
+    books_db.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            books_db.Subject.__table__.insert(),
+            [
+                {"subject_id": i, "subject": f"Subject {i}", "source": "springer"}
+                for i in range(1, subject_count + 1)
+            ],
+        )
+        connection.execute(
+            books_db.Book.__table__.insert(),
+            [
+                {
+                    "book_id": f"10.1007/978-3-031-{i:05}-3",
+                    "title": f"Book {i}",
+                    "ebook_isbn": f"978-3-031-{i:05}-3",
+                    "publisher": "Springer",
+                    "language": "en",
+                    "published": "2023-01-01",
+                    "authors": "Author, A|Author, B",
+                }
+                for i in range(count)
+            ],
+        )
+        connection.execute(
+            books_db.Link.__table__.insert(),
+            [
+                {
+                    "book_id": f"10.1007/978-3-031-{i:05}-3",
+                    "pub_type": pub_type,
+                    "href": f"http://link.springer.com/{pub_type}/{i}",
+                }
+                for i in range(count)
+                for pub_type in ("pdf", "epub")
+            ],
+        )
+        connection.execute(
+            books_db.association_table.insert(),
+            [
+                {
+                    "book_id": f"10.1007/978-3-031-{i:05}-3",
+                    "subject_id": (i + offset) % subject_count + 1,
+                }
+                for i in range(count)
+                for offset in range(3)
+            ],
+        )
+
+
 class TestGenerateFeed(unittest.TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.json_dir = Path(temp_dir.name, "feed")
+        self.json_dir.mkdir()
+        # with the same pragmas as the worker processes, so that they do not
+        # switch the database to WAL while this process is reading it
+        self.engine = books_db.create_db_engine(f"sqlite:///{temp_dir.name}/feed.db")
+        self.addCleanup(self.engine.dispose)
+        books_db.bind_engine(self.engine)
+        self.addCleanup(books_db.bind_engine, None)
+        self.session = books_db.get_session()
+
+    def generate_feed(self, page_size=100):
+        generate_feed = GenerateFeed()
+        generate_feed.json_dir = self.json_dir
+        generate_feed.page_size = page_size
+        return generate_feed
+
+    def read_pages(self, generate_feed):
+        pages = []
+        for page_number in range(1, generate_feed.total_pages + 1):
+            page_path = Path(
+                self.json_dir, f"{generate_feed.feed_base_name}_{page_number}.json"
+            )
+            with open(page_path) as f:
+                pages.append(json.load(f))
+        return pages
+
     def test_init(self):
         generate_feed = GenerateFeed()
         self.assertTrue(generate_feed)
 
+    def test_opds_feed(self):
+        create_catalog(self.engine, 250)
+        generate_feed = self.generate_feed()
+        generate_feed.opds_feed()
+        pages = self.read_pages(generate_feed)
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(
+            [page["metadata"]["itemsPerPage"] for page in pages], [100, 100, 50]
+        )
+        book_ids = {
+            publication["metadata"]["identifier"]
+            for page in pages
+            for publication in page["publications"]
+        }
+        self.assertEqual(len(book_ids), 250)
+        publication = pages[0]["publications"][0]
+        self.assertEqual(len(publication["metadata"]["subject"]), 4)
+        self.assertEqual(len(publication["links"]), 2)
+
+    def test_opds_feed_incremental(self):
+        create_catalog(self.engine, 250)
+        generate_feed = self.generate_feed()
+        generate_feed.opds_feed()
+        stale_page = generate_feed.page_path(4)
+        stale_page.write_text("{}")
+        pages = [generate_feed.page_path(n) for n in range(1, 4)]
+        mtimes = [page.stat().st_mtime_ns for page in pages]
+        sleep(0.01)
+        generate_feed.opds_feed()
+        self.assertEqual([page.stat().st_mtime_ns for page in pages], mtimes)
+        self.assertFalse(stale_page.exists())
+        with self.engine.begin() as connection:
+            connection.execute(
+                books_db.Book.__table__.insert(),
+                [
+                    {
+                        "book_id": f"10.1007/978-3-032-{i:05}-3",
+                        "title": f"New book {i}",
+                        "created": datetime.now() + timedelta(days=1),
+                    }
+                    for i in range(30)
+                ],
+            )
+        generate_feed.opds_feed()
+        new_mtimes = [page.stat().st_mtime_ns for page in pages]
+        self.assertEqual(new_mtimes[:2], mtimes[:2])
+        self.assertNotEqual(new_mtimes[2], mtimes[2])
+        last_page = self.read_pages(generate_feed)[-1]
+        self.assertEqual(last_page["metadata"]["numberOfItems"], 280)
+        self.assertEqual(
+            last_page["publications"][-1]["metadata"]["title"], "New book 29"
+        )
+
+    def test_opds_feed_updated_book(self):
+        create_catalog(self.engine, 250)
+        generate_feed = self.generate_feed()
+        generate_feed.opds_feed()
+        pages = [generate_feed.page_path(n) for n in range(1, 4)]
+        mtimes = [page.stat().st_mtime_ns for page in pages]
+        sleep(0.01)
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(books_db.Book)
+                .where(books_db.Book.book_id == "10.1007/978-3-031-00010-3")
+                .values(title="Corrected Title")
+            )
+        generate_feed.opds_feed()
+        new_mtimes = [page.stat().st_mtime_ns for page in pages]
+        self.assertNotEqual(new_mtimes[0], mtimes[0])
+        self.assertEqual(new_mtimes[1:], mtimes[1:])
+        titles = [
+            publication["metadata"]["title"]
+            for publication in self.read_pages(generate_feed)[0]["publications"]
+        ]
+        self.assertEqual(titles[10], "Corrected Title")
+
+    def test_opds_feed_versions(self):
+        create_catalog(self.engine, 250)
+        generate_feed = self.generate_feed()
+        generate_feed.keep_versions = 2
+        generate_feed.opds_feed()
+        self.assertTrue(self.json_dir.is_symlink())
+        first_version = self.json_dir.resolve()
+        with self.engine.begin() as connection:
+            connection.execute(
+                books_db.Book.__table__.insert(),
+                {
+                    "book_id": "10.1007/978-3-032-00000-3",
+                    "created": datetime.now() + timedelta(days=1),
+                },
+            )
+        generate_feed.opds_feed()
+        second_version = self.json_dir.resolve()
+        self.assertNotEqual(first_version, second_version)
+        self.assertEqual(
+            generate_feed.page_path(1, first_version).stat().st_ino,
+            generate_feed.page_path(1, second_version).stat().st_ino,
+        )
+        self.assertNotEqual(
+            generate_feed.page_path(3, first_version).read_bytes(),
+            generate_feed.page_path(3, second_version).read_bytes(),
+        )
+        generate_feed.opds_feed()
+        versions = sorted(generate_feed.versions_dir.iterdir())
+        self.assertEqual(versions, [second_version, self.json_dir.resolve()])
+        self.assertEqual(
+            sorted(p.name for p in self.json_dir.iterdir()),
+            [generate_feed.page_path(n).name for n in (1, 2, 3)],
+        )
+
+    def test_remove_old_versions(self):
+        generate_feed = self.generate_feed()
+        generate_feed.versions_dir = Path(self.json_dir.parent, "versions")
+        names = [
+            "20261016000000000000",
+            "20261017000000000000.partial",
+            "20261017000000000000",
+            "20261018000000000000",
+            "20261019000000000000.partial",
+        ]
+        for name in names:
+            Path(generate_feed.versions_dir, name).mkdir(parents=True)
+        current_dir = Path(generate_feed.versions_dir, "20261018000000000000")
+        generate_feed.keep_versions = 0
+        generate_feed.remove_old_versions(current_dir)
+        self.assertEqual(
+            sorted(p.name for p in generate_feed.versions_dir.iterdir()),
+            ["20261018000000000000", "20261019000000000000.partial"],
+        )
+
+    def test_opds_feed_precompress(self):
+        create_catalog(self.engine, 150)
+        generate_feed = self.generate_feed()
+        generate_feed.compressors = [feed_generator.COMPRESSORS["gzip"]]
+        if feed_generator.brotli:
+            generate_feed.compressors.append(feed_generator.COMPRESSORS["br"])
+        generate_feed.opds_feed()
+        first_version = self.json_dir.resolve()
+        with self.engine.begin() as connection:
+            connection.execute(
+                books_db.Book.__table__.insert(),
+                {
+                    "book_id": "10.1007/978-3-032-00000-3",
+                    "created": datetime.now() + timedelta(days=1),
+                },
+            )
+        generate_feed.opds_feed()
+        for page_number in (1, 2):
+            page_path = generate_feed.page_path(page_number)
+            page_bytes = page_path.read_bytes()
+            gzip_path = Path(f"{page_path}.gz")
+            self.assertEqual(gzip.decompress(gzip_path.read_bytes()), page_bytes)
+            if feed_generator.brotli:
+                brotli_path = Path(f"{page_path}.br")
+                self.assertEqual(
+                    feed_generator.brotli.decompress(brotli_path.read_bytes()),
+                    page_bytes,
+                )
+        unchanged_gzip = Path(f"{generate_feed.page_path(1)}.gz")
+        self.assertEqual(
+            unchanged_gzip.stat().st_ino,
+            Path(first_version, unchanged_gzip.name).stat().st_ino,
+        )
+
+    def test_opds_feed_workers(self):
+        books_db.Base.metadata.create_all(self.engine)
+        self.generate_feed().opds_feed(workers=3)
+        self.assertEqual(list(self.json_dir.iterdir()), [])
+        create_catalog(self.engine, 450)
+        with self.engine.begin() as connection:
+            connection.execute(
+                books_db.Book.__table__.insert(),
+                [
+                    {
+                        "book_id": f"10.1007/978-3-032-{i:05}-3",
+                        "title": f"New book {i}",
+                        "created": datetime(2100, 1, 1, 0, 0, i % 3),
+                    }
+                    for i in range(30)
+                ],
+            )
+        generate_feed = self.generate_feed()
+        generate_feed.opds_feed()
+        serial_pages = [generate_feed.page_path(n).read_bytes() for n in range(1, 6)]
+        for page_number in range(1, 6):
+            generate_feed.page_path(page_number).unlink()
+        generate_feed.opds_feed(workers=3)
+        parallel_pages = [generate_feed.page_path(n).read_bytes() for n in range(1, 6)]
+        self.assertEqual(parallel_pages, serial_pages)
+
+    def test_opds_feed_metrics(self):
+        create_catalog(self.engine, 250)
+        feed_generator.metrics.reset()
+        self.generate_feed().opds_feed(workers=2)
+        summary = feed_generator.metrics.summary()
+        self.assertEqual(summary["timers"]["feed.create_json"]["count"], 250)
+        self.assertEqual(summary["timers"]["feed.write_json"]["count"], 3)
+        self.assertEqual(summary["counters"]["feed.pages_changed"], 3)
+        page_bytes = sum(
+            path.stat().st_size for path in self.json_dir.resolve().iterdir()
+        )
+        self.assertEqual(summary["counters"]["feed.bytes_written"], page_bytes)
+
+    def test_opds_feed_page_hook(self):
+        create_catalog(self.engine, 250)
+        pages = []
+        self.generate_feed().opds_feed(page_hook=pages.append)
+        self.assertEqual(pages, [1, 2, 3])
+        pages = []
+        self.generate_feed().opds_feed(workers=2, page_hook=pages.append)
+        self.assertEqual(pages, [1, 2, 3])
+
+    def test_opds_feed_queries(self):
+        create_catalog(self.engine, 450)
+        generate_feed = self.generate_feed()
+        statements = []
+        page_statements = []
+        write_json = generate_feed.write_json
+
+        def count_statements(page_number, opds_page):
+            page_statements.append(len(statements))
+            write_json(page_number, opds_page)
+
+        event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        with patch.object(generate_feed, "write_json", count_statements):
+            generate_feed.opds_feed()
+        queries_per_page = [
+            end - start for start, end in zip(page_statements, page_statements[1:])
+        ]
+        # one query for the page of books and one batched query each for
+        # subjects and links, however many books
+        self.assertEqual(queries_per_page, [3, 3, 3, 3])
+        self.assertEqual(len(statements), 16)
+
+    def test_get_page_books(self):
+        create_catalog(self.engine, 250)
+        generate_feed = self.generate_feed()
+        generate_feed.total_pubs, generate_feed.total_pages = 250, 3
+        pages = [books for _, books in generate_feed.iter_pages()]
+        self.assertEqual([len(books) for books in pages], [100, 100, 50])
+        book_ids = [book.book_id for books in pages for book in books]
+        self.assertEqual(len(set(book_ids)), 250)
+        after_key = generate_feed.page_keys()[0]
+        books, _ = generate_feed.get_page_books(after_key)
+        self.assertEqual(books[0].book_id, pages[1][0].book_id)
+
+    def test_get_page_books_uses_index(self):
+        create_catalog(self.engine, 10)
+        statements = []
+        event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, parameters, *args: statements.append(
+                (statement, parameters)
+            ),
+        )
+        self.generate_feed().get_page_books(("2022-01-01 00:00:00", "book_id"))
+        statement, parameters = statements[0]
+        with self.engine.connect() as connection:
+            plan = connection.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", parameters
+            ).all()
+        self.assertIn("USING INDEX ix_book_created_book_id", plan[0][-1])
+
+    def test_opds_feed_memory(self):
+        create_catalog(self.engine, 4000)
+        generate_feed = self.generate_feed()
+        identity_map_sizes = []
+        write_json = generate_feed.write_json
+
+        def record_identity_map(page_number, opds_page):
+            identity_map_sizes.append(len(self.session.identity_map))
+            write_json(page_number, opds_page)
+
+        with patch.object(generate_feed, "write_json", record_identity_map):
+            tracemalloc.start()
+            generate_feed.opds_feed()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.assertEqual(len(identity_map_sizes), 40)
+        # only subjects, which are shared between books, stay in the session
+        self.assertLessEqual(max(identity_map_sizes), 50 + generate_feed.page_size)
+        # peak memory is a few pages of books, not the 4000 book catalog
+        self.assertLess(peak, 10 * 1024 * 1024)
+
+
+class TestEncodeJson(unittest.TestCase):
+    def setUp(self):
+        with open(Path("fixtures", "springer_opds_feed_1_record.json")) as f:
+            self.opds_page = json.load(f)
+
+    def test_encode_json(self):
+        for orjson in (feed_generator.orjson, None):
+            with patch("opds_springer.feed_generator.orjson", orjson):
+                indented = feed_generator.encode_json(self.opds_page)
+                compact = feed_generator.encode_json(self.opds_page, indent=False)
+            self.assertIsInstance(indented, bytes)
+            self.assertEqual(json.loads(indented), self.opds_page)
+            self.assertEqual(json.loads(compact), self.opds_page)
+            self.assertLess(len(compact), len(indented))
+            self.assertNotIn(b"\n", compact)
+
+    @unittest.skipUnless(feed_generator.orjson, "orjson is not installed")
+    def test_encode_json_backends(self):
+        self.opds_page["metadata"]["title"] = "Müller – Analysis"
+        for indent in (True, False):
+            orjson_bytes = feed_generator.encode_json(self.opds_page, indent)
+            with patch("opds_springer.feed_generator.orjson", None):
+                stdlib_bytes = feed_generator.encode_json(self.opds_page, indent)
+            self.assertEqual(stdlib_bytes, orjson_bytes)
+            self.assertIn("Müller".encode(), stdlib_bytes)
+
+
+class TestCompressors(unittest.TestCase):
+    def setUp(self):
+        self.data = Path("fixtures", "springer_opds_feed_1_record.json").read_bytes()
+
+    def test_gzip_compress(self):
+        compressed = feed_generator.gzip_compress(self.data)
+        self.assertEqual(gzip.decompress(compressed), self.data)
+        # no timestamp in the header, so the output is the same every time
+        self.assertEqual(compressed[4:8], bytes(4))
+        self.assertEqual(feed_generator.gzip_compress(self.data), compressed)
+
+    @unittest.skipUnless(feed_generator.brotli, "brotli is not installed")
+    def test_brotli_compress(self):
+        for quality in (4, 11):
+            compressed = feed_generator.brotli_compress(self.data, quality)
+            self.assertEqual(feed_generator.brotli.decompress(compressed), self.data)
+
 
 class TestBookOPDS(unittest.TestCase):
     def get_random_book(self):
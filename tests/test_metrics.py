@@ -0,0 +1,59 @@
+import json
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+
+from opds_springer.metrics import Metrics, instrument_engine, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_timer(self):
+        run_metrics = Metrics()
+        for seconds in (1.0, 3.0):
+            with patch("opds_springer.metrics.perf_counter", side_effect=[0, seconds]):
+                with run_metrics.timer("api.request"):
+                    pass
+        run_metrics.count("feed.bytes_written", 100)
+        run_metrics.count("feed.bytes_written", 50)
+        summary = run_metrics.summary()
+        self.assertEqual(
+            summary["timers"]["api.request"],
+            {"count": 2, "total": 4.0, "mean": 2.0, "max": 3.0},
+        )
+        self.assertEqual(summary["counters"], {"feed.bytes_written": 150})
+
+    def test_collect_merge(self):
+        worker_metrics = Metrics()
+        worker_metrics.add_time("feed.write_json", 2.0)
+        worker_metrics.count("feed.pages_changed")
+        run_metrics = Metrics()
+        run_metrics.add_time("feed.write_json", 1.0)
+        run_metrics.merge(worker_metrics.collect())
+        run_metrics.merge(worker_metrics.collect())
+        summary = run_metrics.summary()
+        self.assertEqual(summary["timers"]["feed.write_json"]["count"], 2)
+        self.assertEqual(summary["timers"]["feed.write_json"]["max"], 2.0)
+        self.assertEqual(summary["counters"], {"feed.pages_changed": 1})
+
+    def test_write_summary(self):
+        run_metrics = Metrics()
+        run_metrics.count("books.added", 3)
+        with TemporaryDirectory() as temp_dir:
+            summary_path = Path(temp_dir, "metrics.json")
+            with self.assertLogs(level="INFO") as logs:
+                run_metrics.write_summary(summary_path)
+            summary = json.loads(summary_path.read_text())
+        self.assertEqual(summary["counters"], {"books.added": 3})
+        self.assertIn('"books.added": 3', logs.output[0])
+
+    def test_instrument_engine(self):
+        engine = create_engine("sqlite://")
+        instrument_engine(engine)
+        metrics.reset()
+        with engine.connect() as connection:
+            for _ in range(3):
+                connection.exec_driver_sql("SELECT 1")
+        self.assertEqual(metrics.summary()["timers"]["db.query"]["count"], 3)
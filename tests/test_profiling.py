@@ -0,0 +1,40 @@
+import pstats
+import tracemalloc
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from opds_springer.profiling import profile_phase
+
+
+def build_pages():
+    return [{"page": i, "books": list(range(100))} for i in range(100)]
+
+
+class TestProfilePhase(unittest.TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.output_dir = temp_dir.name
+
+    def test_profile(self):
+        with profile_phase("feed", profile=True, output_dir=self.output_dir):
+            build_pages()
+        (stats_path,) = Path(self.output_dir).glob("feed_*.pstats")
+        stats = pstats.Stats(str(stats_path))
+        functions = [function for _, _, function in stats.stats]
+        self.assertIn("build_pages", functions)
+
+    def test_trace_memory(self):
+        with self.assertLogs(level="INFO") as logs:
+            with profile_phase("feed", trace_memory=True):
+                pages = build_pages()
+        self.assertEqual(len(pages), 100)
+        self.assertIn("Top allocations at end of feed", logs.output[0])
+        self.assertIn("test_profiling.py", logs.output[0])
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_off(self):
+        with profile_phase("feed", output_dir=self.output_dir):
+            self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(list(Path(self.output_dir).iterdir()), [])
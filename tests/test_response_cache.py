@@ -0,0 +1,80 @@
+import json
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import responses
+
+from opds_springer.book_saver import SpringerClient
+from opds_springer.response_cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_path = Path(temp_dir.name, "cache.db")
+        self.params = {"q": "doi:10.1007/978-1-349-11550-1", "api_key": "api_key"}
+
+    def test_get(self):
+        response_cache = ResponseCache(self.cache_path)
+        self.assertIsNone(response_cache.get(self.params))
+        response_cache.set(self.params, {"records": []})
+        self.assertEqual(response_cache.get(self.params), {"records": []})
+        self.assertEqual(
+            response_cache.get(dict(self.params, api_key="new_key")), {"records": []}
+        )
+        self.assertEqual((response_cache.hits, response_cache.misses), (2, 1))
+
+    def test_key(self):
+        response_cache = ResponseCache(self.cache_path)
+        self.assertEqual(
+            response_cache.key({"s": 1, "q": "doi:x", "api_key": "api_key"}),
+            "q=doi%3Ax&s=1",
+        )
+
+    def test_ttl(self):
+        response_cache = ResponseCache(self.cache_path, ttl=60)
+        with patch("opds_springer.response_cache.time", return_value=1000):
+            response_cache.set(self.params, {"records": []})
+        with patch("opds_springer.response_cache.time", return_value=1061):
+            self.assertIsNone(response_cache.get(self.params))
+        self.assertEqual(response_cache.size, 0)
+
+    def test_lru_eviction(self):
+        body_size = len(json.dumps({"records": ["x" * 100]}))
+        response_cache = ResponseCache(
+            self.cache_path, max_size=body_size * 2.5 / 1024 / 1024
+        )
+        for s in range(3):
+            with patch("opds_springer.response_cache.time", return_value=s):
+                response_cache.set(dict(self.params, s=s), {"records": ["x" * 100]})
+            with patch("opds_springer.response_cache.time", return_value=10):
+                response_cache.get(dict(self.params, s=0))
+        with patch("opds_springer.response_cache.time", return_value=10):
+            self.assertIsNotNone(response_cache.get(dict(self.params, s=0)))
+            self.assertIsNone(response_cache.get(dict(self.params, s=1)))
+            self.assertIsNotNone(response_cache.get(dict(self.params, s=2)))
+        self.assertLessEqual(response_cache.size, body_size * 2.5)
+
+    def test_persistence(self):
+        ResponseCache(self.cache_path).set(self.params, {"records": []})
+        response_cache = ResponseCache(self.cache_path)
+        self.assertEqual(response_cache.get(self.params), {"records": []})
+
+    @responses.activate
+    def test_springer_client(self):
+        with open(Path("fixtures", "springer_book_example.json")) as f:
+            response_json = json.load(f)
+        responses.get(
+            url="https://spdi.public.springernature.app/bookmeta/v1/json",
+            json=response_json,
+        )
+        springer_client = SpringerClient(
+            "api_key", "entitlement_id", cache=ResponseCache(self.cache_path)
+        )
+        for _ in range(3):
+            record = springer_client.request_book("10.1007/978-1-349-11550-1")
+        self.assertEqual(record, response_json["records"][0])
+        self.assertEqual(len(responses.calls), 1)
@@ -1,7 +1,10 @@
 import argparse
 
 from opds_springer.book_saver import BookData
+from opds_springer.books_db import create_schema
 from opds_springer.feed_generator import GenerateFeed
+from opds_springer.metrics import metrics
+from opds_springer.profiling import log_page_allocations, profile_phase
 
 
 def main():
@@ -9,9 +12,60 @@ def main():
         description="Add recent books to database and create an updated OPDS feed."
     )
     parser.add_argument("days", help="Number of days ago to get books from.", type=int)
+    parser.add_argument(
+        "--kbart",
+        action="store_true",
+        help="Also add books from the configured KBART file.",
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        help="Number of concurrent Springer API requests for KBART books.",
+        type=int,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the Springer API response cache.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue unfinished ingest runs from their last checkpoint.",
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes writing feed pages.",
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write a JSON summary of timings and counts for the run to this file.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Write a cProfile .pstats file for each phase of the run.",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Log the top memory allocation sites after each feed page and phase.",
+    )
     args = parser.parse_args()
-    BookData().save_books_from_api(args.days)
-    GenerateFeed().opds_feed()
+    profiling = {"profile": args.profile, "trace_memory": args.trace_memory}
+    create_schema()
+    book_data = BookData(use_cache=not args.no_cache)
+    if args.kbart:
+        with metrics.timer("run.kbart_ingest"), profile_phase(
+            "kbart_ingest", **profiling
+        ):
+            book_data.save_books_from_kbart(args.fetch_workers, resume=args.resume)
+    with metrics.timer("run.api_ingest"), profile_phase("api_ingest", **profiling):
+        book_data.save_books_from_api(args.days, resume=args.resume)
+    page_hook = log_page_allocations if args.trace_memory else None
+    with metrics.timer("run.feed"), profile_phase("feed", **profiling):
+        GenerateFeed().opds_feed(args.workers, page_hook)
+    metrics.write_summary(args.metrics_file)
 
 
 if __name__ == "__main__":